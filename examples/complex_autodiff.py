@@ -6,36 +6,32 @@ Example demonstrating autodifferentiation of complex expressions:
 """
 
 from src.core.tracer import constant, add, mul, div, trace, Node
-from src.core.autodiff import compute_gradients
+from src.core.autodiff import compute_gradients, topological_sort
 import graphviz
 
+def _label(n: Node) -> str:
+    """Return the graphviz label for a node."""
+    label = n.op if isinstance(n.op, str) else n.op.__name__
+    value = getattr(n, 'value', None)
+    if value is not None:
+        label += f"\nvalue={value}"
+    label += f"\ngrad={getattr(n, 'grad', None)}"
+    return label
+
 def create_visualization(node: Node, filename: str):
     """Create a graphviz visualization of the computation graph."""
     dot = graphviz.Digraph(comment='Computation Graph')
     dot.attr(rankdir='TB')
     
-    visited = set()
-    
-    def add_nodes(n: Node):
-        if n.id in visited:
-            return
-        visited.add(n.id)
-        
-        # Add node
-        label = f"{n.op if isinstance(n.op, str) else n.op.__name__}"
-        if hasattr(n, 'value') and n.value is not None:
-            label += f"\nvalue={n.value}"
-        if hasattr(n, 'grad'):
-            label += f"\ngrad={n.grad}"
-        
-        dot.node(n.id, label)
-        
-        # Add edges from inputs
+    # One pass over the topological order: each node (including the shared x)
+    # is labelled once, and edges are emitted without recursion.
+    nodes = topological_sort(node)
+    labels = {n.id: _label(n) for n in nodes}
+    for n in nodes:
+        dot.node(f"n{n.id}", labels[n.id])
         for inp in n.inputs:
-            add_nodes(inp)
-            dot.edge(inp.id, n.id)
+            dot.edge(f"n{inp.id}", f"n{n.id}")
     
-    add_nodes(node)
     dot.render(filename, view=True, format='png')
 
 def main():
@@ -13,6 +13,12 @@ setup(
         "dev": [
             "pytest>=7.0.0",
         ],
+        "numba": [
+            "numba>=0.58.0",
+        ],
+        "jax": [
+            "jax>=0.4.0",
+        ],
     },
     python_requires=">=3.8",
     author="Surya Subramanian",
@@ -3,102 +3,274 @@ Module: autodiff.py
 Implements automatic differentiation for the computation graph.
 """
 
-from typing import List
-from .tracer import Node
+from functools import reduce
+from typing import Any, Dict, List, Optional, Tuple
+from .tracer import Node, evaluate_all, topological_sort
 import torch
 
-def topological_sort(node: Node) -> List[Node]:
+# Scalar graphs with at least this many nodes, and on average this many nodes
+# per dependency level, are differentiated with batched index_add_ kernels
+# instead of the per-node Python loop.
+_VECTORIZE_MIN_NODES = 64
+_VECTORIZE_MIN_WIDTH = 8
+
+_SCALAR_OPS = {
+    "add": lambda a, b: a + b,
+    "mul": lambda a, b: a * b,
+    "div": lambda a, b: a / b,
+}
+
+# Vector-Jacobian products: (upstream grad, *input values) -> input grads.
+_VJPS = {
+    # d(a+b)/da = d(a+b)/db = 1
+    "add": lambda g, a, b: (g, g),
+    # dz/da = b and dz/db = a
+    "mul": lambda g, a, b: (g * b, g * a),
+    # dz/da = 1 / b and dz/db = -a / b^2
+    "div": lambda g, a, b: (g / b, -g * a / (b * b)),
+    "neg": lambda g, a: (-g,),
+    "recip": lambda g, a: (-g / (a * a),),
+    "square": lambda g, a: (2.0 * a * g,),
+    "cube": lambda g, a: (3.0 * a * a * g,),
+}
+
+# Ops whose VJP does not read its input values, so inputs that could not be
+# evaluated (custom nodes with only a grad_fn) can still be differentiated.
+_VALUE_FREE_VJPS = {"add", "neg"}
+
+class _GradPlan:
     """
-    Return nodes in topologically sorted order.
+    Vectorized reverse pass for a scalar graph.
     
-    Args:
-        node (Node): The output node.
+    Nodes are indexed by their topological position. Each node is assigned a
+    level (its longest distance from the output), so once every node at lower
+    levels has been processed its gradient is final. The reverse pass then
+    runs one group of index_add_ kernels per (level, op) pair instead of one
+    Python step per node.
+    """
+
+    def __init__(self, lhs: List[int], rhs: List[int],
+                 steps: List[Tuple[str, torch.Tensor, torch.Tensor, torch.Tensor]]):
+        self.lhs = lhs
+        self.rhs = rhs
+        self.steps = steps
+
+    def run(self, nodes: List[Node], seed_grad: float) -> bool:
+        """
+        Compute gradients for ``nodes``, the topological order the plan was
+        built from. The plan is cached on the root, so it does not keep the
+        nodes itself.
+        
+        Returns:
+            bool: False if a node holds a tensor (or missing) value, in which
+            case nothing was written and the caller must fall back to the
+            generic path.
+        """
+        values = [0.0] * len(nodes)
+        for i, n in enumerate(nodes):
+            v = n.value
+            if v is None and n.inputs:
+                v = _SCALAR_OPS[n.op](values[self.lhs[i]], values[self.rhs[i]])
+            elif v is None or isinstance(v, torch.Tensor):
+                return False
+            values[i] = v
+
+        vals = torch.tensor(values, dtype=torch.float64)
+        grads = torch.zeros_like(vals)
+        grads[-1] = seed_grad  # The output is last in topological order.
+        for op, out, a, b in self.steps:
+            g = grads[out]
+            if op == "add":
+                grads.index_add_(0, a, g)
+                grads.index_add_(0, b, g)
+            elif op == "mul":
+                grads.index_add_(0, a, g * vals[b])
+                grads.index_add_(0, b, g * vals[a])
+            else:
+                vb = vals[b]
+                grads.index_add_(0, a, g / vb)
+                grads.index_add_(0, b, -g * vals[a] / (vb * vb))
+
+        for n, g in zip(nodes, grads.tolist()):
+            n.grad = g
+        return True
+
+def _build_grad_plan(sorted_nodes: List[Node]) -> Optional[_GradPlan]:
+    """
+    Build a vectorized reverse pass for ``sorted_nodes``.
+    
+    Returns:
+        Optional[_GradPlan]: None if the graph is too small or too deep to
+        benefit, or contains operations other than add/mul/div.
+    """
+    n_nodes = len(sorted_nodes)
+    if n_nodes < _VECTORIZE_MIN_NODES:
+        return None
+
+    position = {id(n): i for i, n in enumerate(sorted_nodes)}
+    lhs = [0] * n_nodes
+    rhs = [0] * n_nodes
+    level = [0] * n_nodes
+    for i in range(n_nodes - 1, -1, -1):
+        n = sorted_nodes[i]
+        if n.op == "const" and not n.inputs:
+            continue
+        if n.op not in _SCALAR_OPS or len(n.inputs) != 2:
+            return None
+        lhs[i] = position[id(n.inputs[0])]
+        rhs[i] = position[id(n.inputs[1])]
+        for j in (lhs[i], rhs[i]):
+            if level[j] < level[i] + 1:
+                level[j] = level[i] + 1
+
+    if n_nodes < (max(level) + 1) * _VECTORIZE_MIN_WIDTH:
+        return None
+
+    groups: Dict[Tuple[int, str], Tuple[List[int], List[int], List[int]]] = {}
+    for i, n in enumerate(sorted_nodes):
+        if n.op in _SCALAR_OPS:
+            out, a, b = groups.setdefault((level[i], n.op), ([], [], []))
+            out.append(i)
+            a.append(lhs[i])
+            b.append(rhs[i])
+
+    steps = [
+        (op, torch.tensor(out), torch.tensor(a), torch.tensor(b))
+        for (_, op), (out, a, b) in sorted(groups.items())
+    ]
+    return _GradPlan(lhs, rhs, steps)
+
+def _promote(values: Dict[int, Any]) -> Tuple[Dict[int, Any], bool]:
+    """
+    If any value is a tensor, promote every value to a tensor of one common
+    floating dtype on the first tensor's device.
     
     Returns:
-        List[Node]: Nodes in topological order.
+        Tuple[Dict[int, Any], bool]: The values, and whether they are tensors.
     """
-    visited = set()
-    order = []
+    tensors = [v for v in values.values() if isinstance(v, torch.Tensor)]
+    if not tensors:
+        return values, False
+    dtype = reduce(torch.promote_types, (t.dtype for t in tensors))
+    if not dtype.is_floating_point:
+        dtype = torch.get_default_dtype()
+    device = tensors[0].device
+    return {k: torch.as_tensor(v, dtype=dtype, device=device) for k, v in values.items()}, True
 
-    def visit(n: Node):
-        if n.id in visited:
-            return
-        visited.add(n.id)
-        for inp in n.inputs:
-            visit(inp)
-        order.append(n)
+def has_vjp(node: Node) -> bool:
+    """True if the reverse pass differentiates ``node`` without a grad_fn."""
+    return node.op == "const" or node.op in _VJPS
 
-    visit(node)
-    return order
+def tape_gradients(tape: List[Node], output: Node, values: Dict[int, Any],
+                   seed_grad: float = 1.0) -> Dict[int, Any]:
+    """
+    Reverse-mode autodiff as one linear scan over a recorded tape.
+    
+    Args:
+        tape (List[Node]): Nodes in creation order, as recorded by a Tape.
+        output (Node): The node to differentiate, recorded on the tape.
+        values (Dict[int, Any]): Forward values keyed by ``id(node)``, for
+            the tape's nodes and their inputs.
+        seed_grad (float): Initial gradient value for the output node.
+    
+    Returns:
+        Dict[int, Any]: Gradients keyed by ``id(node)``. Nodes the output
+        does not depend on are absent.
+    
+    Raises:
+        ValueError: If the output depends on an operation without a
+            closed-form derivative.
+    """
+    values, is_tensor = _promote(values)
+    out = id(output)
+    grads: Dict[int, Any] = {
+        out: torch.ones_like(values[out]) * seed_grad if is_tensor else seed_grad
+    }
+    for n in reversed(tape):
+        g = grads.get(id(n))
+        if g is None or n.op == "const":
+            continue
+        vjp = _VJPS.get(n.op)
+        if vjp is None:
+            raise ValueError(f"No derivative for operation: {n.op}")
+        for inp, contrib in zip(n.inputs, vjp(g, *(values[id(inp)] for inp in n.inputs))):
+            prev = grads.get(id(inp))
+            grads[id(inp)] = contrib if prev is None else prev + contrib
+    return grads
+
+def _zeroed_buffer(node: Node, like: torch.Tensor) -> torch.Tensor:
+    """Return ``node``'s gradient buffer, zeroed, reallocating it if ``like`` no longer matches."""
+    buffer = node._grad_buffer
+    if (buffer is None or buffer.shape != like.shape or buffer.dtype != like.dtype
+            or buffer.device != like.device):
+        buffer = node._grad_buffer = torch.zeros_like(like)
+    else:
+        buffer.zero_()
+    return buffer
 
 def compute_gradients(node: Node, seed_grad: float = 1.0):
     """
     Compute gradients through the computation graph using reverse-mode autodiff.
     (Fixed: resets all node gradients and adds a branch for division.)
     
+    Tensor gradients are accumulated in per-node buffers that are zeroed and
+    reused by the next call with the same shapes, so a caller keeping a
+    ``.grad`` across calls should clone it.
+    
     Args:
         node (Node): The output node to compute gradients from.
         seed_grad (float): Initial gradient value for the output node.
     """
-    # Get nodes in topological order.
-    sorted_nodes = topological_sort(node)
-    
-    # Reset gradients for all nodes (this prevents accumulation from prior calls)
-    for n in sorted_nodes:
-        if isinstance(n.value, torch.Tensor):
-            n.grad = torch.zeros_like(n.value)
-        else:
-            n.grad = 0.0
+    # Get nodes in topological order, cached on the root for later calls.
+    sorted_nodes = topological_sort(node, memoize=True)
 
-    # Set the output node's gradient to the seed value.
-    if isinstance(node.value, torch.Tensor):
-        node.grad = torch.ones_like(node.value) * seed_grad
+    # Wide scalar graphs take the vectorized path; the plan is cached on the
+    # root until the graph is rewired.
+    cache = node._grad_plan
+    if cache is None or cache[0] != Node._epoch:
+        cache = node._grad_plan = (Node._epoch, _build_grad_plan(sorted_nodes))
+    if cache[1] is not None and cache[1].run(sorted_nodes, seed_grad):
+        return
+
+    # Evaluate the whole graph once up front instead of per mul/div node.
+    # Custom nodes with a grad_fn need no evaluator: nodes that cannot be
+    # evaluated are left out, and only fail if a derivative needs them.
+    values = evaluate_all(sorted_nodes, skip_unknown=True)
+
+    # Classify the graph once, so the reverse pass below is plain arithmetic
+    # with no per-node type checks.
+    values, is_tensor = _promote(values)
+    if is_tensor:
+        for n in sorted_nodes:
+            v = values.get(id(n))
+            n.grad = _zeroed_buffer(n, v) if v is not None else 0.0
+        if isinstance(node.grad, torch.Tensor):
+            node.grad.fill_(seed_grad)
+        else:
+            node.grad = seed_grad
     else:
+        # Reset gradients for all nodes (this prevents accumulation from prior calls)
+        for n in sorted_nodes:
+            n.grad = 0.0
         node.grad = seed_grad
     
     # Reverse-mode autodiff: process nodes in reverse topological order.
     for n in reversed(sorted_nodes):
-        if n.op == "add":
-            # For addition, d(a+b)/da = d(a+b)/db = 1.
-            for inp in n.inputs:
-                if isinstance(inp.grad, torch.Tensor) or isinstance(n.grad, torch.Tensor):
-                    inp.grad = inp.grad + n.grad if isinstance(inp.grad, torch.Tensor) else torch.tensor(inp.grad) + n.grad
+        vjp = _VJPS.get(n.op)
+        if vjp is not None:
+            if n.op not in _VALUE_FREE_VJPS:
+                for inp in n.inputs:
+                    if id(inp) not in values:
+                        raise ValueError(f"Unknown operation: {inp.op}")
+            grads = vjp(n.grad, *(values.get(id(inp)) for inp in n.inputs))
+            for inp, grad in zip(n.inputs, grads):
+                acc = inp.grad
+                if isinstance(acc, torch.Tensor) and isinstance(grad, torch.Tensor) and acc.shape == grad.shape:
+                    # Accumulate into the buffer; broadcasting contributions
+                    # still need a new tensor.
+                    acc.add_(grad)
                 else:
-                    inp.grad += n.grad
-        elif n.op == "mul":
-            # For multiplication, if z = a * b then:
-            # dz/da = b and dz/db = a.
-            a, b = n.inputs
-            a_val = a.value if a.value is not None else evaluate(a)
-            b_val = b.value if b.value is not None else evaluate(b)
-            if isinstance(n.grad, torch.Tensor) or isinstance(a_val, torch.Tensor) or isinstance(b_val, torch.Tensor):
-                if not isinstance(a_val, torch.Tensor):
-                    a_val = torch.tensor(a_val)
-                if not isinstance(b_val, torch.Tensor):
-                    b_val = torch.tensor(b_val)
-                node_grad = n.grad if isinstance(n.grad, torch.Tensor) else torch.tensor(n.grad)
-                a.grad = a.grad + (node_grad * b_val) if isinstance(a.grad, torch.Tensor) else torch.tensor(a.grad) + (node_grad * b_val)
-                b.grad = b.grad + (node_grad * a_val) if isinstance(b.grad, torch.Tensor) else torch.tensor(b.grad) + (node_grad * a_val)
-            else:
-                a.grad += float(n.grad) * b_val
-                b.grad += float(n.grad) * a_val
-        elif n.op == "div":
-            # For division, if z = a / b then:
-            # dz/da = 1 / b  and  dz/db = -a / (b^2)
-            a, b = n.inputs
-            a_val = a.value if a.value is not None else evaluate(a)
-            b_val = b.value if b.value is not None else evaluate(b)
-            if isinstance(n.grad, torch.Tensor) or isinstance(a_val, torch.Tensor) or isinstance(b_val, torch.Tensor):
-                if not isinstance(a_val, torch.Tensor):
-                    a_val = torch.tensor(a_val)
-                if not isinstance(b_val, torch.Tensor):
-                    b_val = torch.tensor(b_val)
-                node_grad = n.grad if isinstance(n.grad, torch.Tensor) else torch.tensor(n.grad)
-                a.grad = a.grad + (node_grad / b_val) if isinstance(a.grad, torch.Tensor) else torch.tensor(a.grad) + (node_grad / b_val)
-                b.grad = b.grad + (node_grad * (-a_val / (b_val * b_val))) if isinstance(b.grad, torch.Tensor) else torch.tensor(b.grad) + (node_grad * (-a_val / (b_val * b_val)))
-            else:
-                a.grad += n.grad / b_val
-                b.grad += n.grad * (-a_val / (b_val * b_val))
+                    inp.grad = acc + grad
         elif n.op == "const":
             # Constants do not contribute gradients.
             pass
@@ -108,15 +280,3 @@ def compute_gradients(node: Node, seed_grad: float = 1.0):
                 grads = grad_fn(n)
                 for inp, grad in zip(n.inputs, grads):
                     inp.grad += grad
-
-def evaluate(node: Node):
-    if node.op == "const":
-        return node.value
-    elif node.op == "add":
-        return evaluate(node.inputs[0]) + evaluate(node.inputs[1])
-    elif node.op == "mul":
-        return evaluate(node.inputs[0]) * evaluate(node.inputs[1])
-    elif node.op == "div":
-        return evaluate(node.inputs[0]) / evaluate(node.inputs[1])
-    else:
-        raise ValueError(f"Unknown operation: {node.op}")
@@ -4,40 +4,67 @@ Implements the compilation and optimization passes for the computation graph.
 """
 
 import logging
-from typing import Callable, List
+from typing import Callable, List, Union
 from .tracer import Node
-from ..optimizations import cse, constant_folding, dead_code, fusion, patterns
+from .autodiff import topological_sort
+from ..optimizations import cse, constant_folding, dead_code, fusion, numba_backend, jax_backend
+from ..optimizations.patterns import PATTERNS_BY_OP
 
 logging.basicConfig(level=logging.INFO)
 
 class Compiler:
-    def __init__(self):
+    def __init__(self, backend: str = "python"):
         """
         Initialize the compiler with a list of optimization passes.
+        
+        Args:
+            backend (str): "python" returns the optimized graph; "numba" lowers
+                scalar graphs to a compiled kernel and "jax" lowers the graph
+                to an XLA program instead.
         """
+        if backend not in ("python", "numba", "jax"):
+            raise ValueError(f"Unknown backend: {backend}")
+        self.backend = backend
         self.passes: List[Callable[[Node], Node]] = [
             constant_folding.optimize,
+            # Pattern-based simplifications run on the folded graph, before
+            # fusion can absorb the mul/div nodes they match.
+            lambda graph: apply_patterns(graph),
             cse.optimize,
             dead_code.optimize,
             fusion.optimize,
-            # Apply pattern-based simplifications pass.
-            lambda graph: apply_patterns(graph),
         ]
 
-    def compile(self, graph: Node) -> Node:
+    def compile(self, graph: Node) -> Union[Node, Callable]:
         """
         Apply optimization passes to the computation graph.
         
+        With the "numba" and "jax" backends the graph is lowered as traced,
+        since its constant leaves are the kernel's inputs and folding them
+        would bake in their current values; XLA also runs its own folding, CSE
+        and fusion. The kernel is cached on the graph root.
+        
         Args:
             graph (Node): The root of the computation graph.
         
         Returns:
-            Node: The optimized computation graph.
+            Union[Node, Callable]: The optimized computation graph, or a
+            kernel evaluating it for the "numba" and "jax" backends.
         """
+        if self.backend != "python":
+            backend = numba_backend if self.backend == "numba" else jax_backend
+            key = f"{self.backend}_kernel"
+            cached = graph.metadata.get(key)
+            if cached is None or cached[0] != Node._epoch:
+                cached = graph.metadata[key] = (Node._epoch, backend.lower(graph))
+            return cached[1]
+
+        # The passes share the root's order until one of them rewires the graph.
+        topological_sort(graph, memoize=True)
         optimized_graph = graph
         for opt_pass in self.passes:
             pass_name = getattr(opt_pass, '__name__', str(opt_pass))
-            logging.info(f"Applying optimization pass: {pass_name}")
+            logging.info("Applying optimization pass: %s", pass_name)
             optimized_graph = opt_pass(optimized_graph)
         return optimized_graph
 
@@ -51,15 +78,18 @@ def apply_patterns(graph: Node) -> Node:
     Returns:
         Node: The simplified graph.
     """
-    from ..optimizations.patterns import patterns
-
-    def helper(node: Node) -> Node:
-        new_inputs = [helper(inp) for inp in node.inputs]
+    # Inputs precede their users in topological order, so every input has
+    # already been rewritten by the time its user is visited.
+    rewritten = {}
+    for node in topological_sort(graph):
+        new_inputs = [rewritten[id(inp)] for inp in node.inputs]
         node.inputs = new_inputs
-        for pattern in patterns:
+        result = node
+        for pattern in PATTERNS_BY_OP.get(node.op_code, ()):
             if pattern.match(node):
-                logging.info(f"Pattern matched for node {node.id}, applying replacement.")
-                return pattern.replace(node)
-        return node
+                logging.info("Pattern matched for node %d, applying replacement.", node.id)
+                result = pattern.replace(node)
+                break
+        rewritten[id(node)] = result
 
-    return helper(graph)
+    return rewritten[id(graph)]
@@ -3,13 +3,53 @@ Module: tracer.py
 Defines the computation graph, tracing functionality, and memory management.
 """
 
-import uuid
-from typing import List, Any, Callable, Dict
+import itertools
+import operator
+import weakref
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import List, Any, Callable, Dict, Optional, Tuple
 import torch
-from ..metal.metal_ops import metal_add, metal_mul, metal_div, to_tensor, get_device
+from ..metal.metal_ops import to_tensor, get_device
+
+# Source of node ids: small ints are cheap to create and to hash.
+_NEXT_ID = itertools.count()
+
+class Op(IntEnum):
+    """Integer codes of the built-in operations, named after their op strings."""
+    CONST = 0
+    ADD = 1
+    MUL = 2
+    DIV = 3
+    NEG = 4
+    RECIP = 5
+    SQUARE = 6
+    CUBE = 7
+    # Fused operations created by the fusion pass.
+    FMA = 8
+    FNMA = 9
+    FMA_ADD = 10
+    MUL2 = 11
+    ADD2 = 12
+    SCALE = 13
+    FUSED = 14
+
+# Op string -> code; other ops (custom or placeholder nodes) have no code.
+OP_CODES: Dict[str, Op] = {op.name.lower(): op for op in Op}
 
 class Node:
     """A node in the computation graph."""
+
+    # Fixed attribute layout: no per-node __dict__, and attribute access is a
+    # slot offset load rather than a dict lookup.
+    __slots__ = (
+        'id', 'op', 'op_code', '_inputs', 'value', 'grad', 'buffer', 'shape', 'dtype',
+        '_metadata', '_topo_cache', '_grad_plan', '_grad_buffer', '__weakref__',
+    )
+
+    # Bumped whenever any node's inputs are reassigned, invalidating the
+    # topological orders cached on graph roots.
+    _epoch = 0
     
     def __init__(self, op: str = None, inputs: List[Any] = None, value: Any = None):
         """
@@ -20,39 +60,60 @@ class Node:
             inputs (List[Any], optional): List of input nodes or values.
             value (Any, optional): The constant value (if any).
         """
-        self.id = str(uuid.uuid4())
+        self.id = next(_NEXT_ID)
         self.op = op
-        self.inputs = []
+        self.op_code = OP_CODES.get(op)  # Op, or None for ops without a code
+        self._inputs = []
         if inputs:
             for inp in inputs:
                 if isinstance(inp, Node):
-                    self.inputs.append(inp)
-                    inp.ref_count += 1
+                    self._inputs.append(inp)
                 else:
                     # Convert non-Node inputs to constant Nodes
-                    const_node = constant(inp)
-                    self.inputs.append(const_node)
-                    const_node.ref_count += 1
+                    self._inputs.append(constant(inp))
+        self._topo_cache = None  # (epoch, order without this node) memoized by topological_sort
+        self._grad_plan = None  # (epoch, plan) memoized by compute_gradients
+        self._grad_buffer = None  # Tensor gradient storage reused by compute_gradients
         self.value = value
         self.grad = None  # For automatic differentiation
+        self.shape = None  # Output shape, when known; checked by fusion
+        self.dtype = None  # Output torch dtype, when known; checked by fusion
         
         # --- Memory Management Enhancements ---
-        self.ref_count = 0  # Track references for memory management
+        # Node lifetime is managed en bloc by GraphArena rather than refcounts.
         self.buffer = None  # For memory allocation planning
         
-        self.metadata: Dict[str, Any] = {}
+        self._metadata = None  # Allocated on first use, most nodes never need it
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        if self._metadata is None:
+            self._metadata = {}
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata: Dict[str, Any]):
+        self._metadata = metadata
+
+    @property
+    def inputs(self) -> List['Node']:
+        return self._inputs
+
+    @inputs.setter
+    def inputs(self, inputs: List['Node']):
+        # Rewiring to the same nodes is a no-op; compared by identity, since
+        # Node equality is not structural.
+        old = self._inputs
+        if len(inputs) == len(old) and all(a is b for a, b in zip(inputs, old)):
+            return
+        # A rewired node no longer matches its hash-consing key.
+        if self.op in _INTERNED_OPS:
+            key = _intern_key(self.op, self._inputs)
+            if _INTERN.get(key) is self:
+                del _INTERN[key]
+        self._inputs = inputs
+        Node._epoch += 1
 
-    def release(self):
-        """Release memory and decrease ref counts of inputs."""
-        # Release any allocated buffers
-        self.buffer = None
-        
-        # Decrease reference counts of inputs
-        for inp in self.inputs:
-            inp.ref_count -= 1
-            if inp.ref_count == 0:
-                inp.release()
-    
     def __add__(self, other: Any) -> 'Node':
         return add(self, other)
     
@@ -61,15 +122,131 @@ class Node:
         
     def __truediv__(self, other: Any) -> 'Node':
         return div(self, other)
+
+    def __neg__(self) -> 'Node':
+        return neg(self)
     
     def __repr__(self):
         if self.value is not None:
             return f"Const({self.value})"
-        return f"Node(op={self.op}, id={self.id[:6]})"
+        return f"Node(op={self.op}, id={self.id})"
+
+class GraphArena:
+    """
+    Owns every node created by the graph factories while it is active.
+    
+    Nodes are tracked in one list and released together, replacing per-node
+    reference counting (which costs a Python call per node at teardown and
+    never fires on reference cycles).
+    
+    Example:
+        with GraphArena() as arena:
+            expr = add(mul(x, x), 1.0)
+        result = trace(expr)
+        arena.release()
+    """
+
+    def __init__(self):
+        self._nodes: List[Node] = []
+        self._token = None
+
+    def make(self, *args, **kwargs) -> Node:
+        """Create a node owned by this arena."""
+        node = Node(*args, **kwargs)
+        self._nodes.append(node)
+        return node
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __enter__(self) -> 'GraphArena':
+        self._token = _ARENA.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _ARENA.reset(self._token)
+        self._token = None
+
+    def release(self):
+        """Release the buffers of all owned nodes and drop the arena's references."""
+        for node in self._nodes:
+            node.buffer = None
+        self._nodes.clear()
+
+    def __del__(self):
+        self._nodes.clear()
+
+# Arena receiving the nodes built by constant/add/mul/div, if one is active.
+_ARENA: ContextVar[Optional[GraphArena]] = ContextVar("graph_arena", default=None)
+
+class Tape:
+    """
+    Records every node created by the graph factories while it is active.
+    
+    Nodes are recorded in creation order, in which every node follows its
+    inputs, so a reverse pass can scan the tape linearly instead of sorting
+    the graph.
+    
+    Example:
+        with Tape() as tape:
+            expr = add(mul(x, x), 1.0)
+        tape.nodes  # [mul node, const 1.0, add node]
+    """
+
+    def __init__(self):
+        self.nodes: List[Node] = []
+        self._token = None
+
+    def __enter__(self) -> 'Tape':
+        self._token = _TAPE.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _TAPE.reset(self._token)
+        self._token = None
+
+# Tape recording the nodes built by the factories, if one is active.
+_TAPE: ContextVar[Optional[Tape]] = ContextVar("tape", default=None)
+
+def _make(op: str, inputs: List[Any] = None, value: Any = None) -> Node:
+    arena = _ARENA.get()
+    if arena is None:
+        node = Node(op=op, inputs=inputs, value=value)
+    else:
+        node = arena.make(op=op, inputs=inputs, value=value)
+    tape = _TAPE.get()
+    if tape is not None:
+        tape.nodes.append(node)
+    return node
+
+# Hash-consing table: operation nodes built through the factories are shared
+# when their operands are identical, so duplicate subexpressions are never
+# created. Values are weak so entries die with their nodes, and a live node
+# keeps its inputs (and therefore the ids in its key) alive.
+_INTERN: 'weakref.WeakValueDictionary[Tuple, Node]' = weakref.WeakValueDictionary()
+_INTERNED_OPS = {"add", "mul", "div", "neg", "recip", "square", "cube"}
+_COMMUTATIVE_OPS = {"add", "mul"}
+
+def _intern_key(op: str, inputs: List[Node]) -> Tuple:
+    if op in _COMMUTATIVE_OPS and len(inputs) == 2 and id(inputs[1]) < id(inputs[0]):
+        return (op, id(inputs[1]), id(inputs[0]))
+    return (op, *(id(inp) for inp in inputs))
+
+def _interned(op: str, *inputs: Node) -> Node:
+    key = _intern_key(op, inputs)
+    node = _INTERN.get(key)
+    if node is None:
+        node = _make(op, list(inputs))
+        _INTERN[key] = node
+    return node
+
+def clear_intern():
+    """Forget all hash-consed nodes; existing graphs are unaffected."""
+    _INTERN.clear()
 
 def constant(value: Any) -> Node:
     """Create a constant node."""
-    return Node(op="const", value=value)
+    return _make("const", value=value)
 
 def add(a: Any, b: Any) -> Node:
     """Add two values."""
@@ -77,7 +254,7 @@ def add(a: Any, b: Any) -> Node:
         a = constant(a)
     if not isinstance(b, Node):
         b = constant(b)
-    return Node(op="add", inputs=[a, b])
+    return _interned("add", a, b)
 
 def mul(a: Any, b: Any) -> Node:
     """Multiply two values."""
@@ -85,7 +262,7 @@ def mul(a: Any, b: Any) -> Node:
         a = constant(a)
     if not isinstance(b, Node):
         b = constant(b)
-    return Node(op="mul", inputs=[a, b])
+    return _interned("mul", a, b)
 
 def div(a: Any, b: Any) -> Node:
     """Divide two values."""
@@ -93,7 +270,149 @@ def div(a: Any, b: Any) -> Node:
         a = constant(a)
     if not isinstance(b, Node):
         b = constant(b)
-    return Node(op="div", inputs=[a, b])
+    return _interned("div", a, b)
+
+def neg(a: Any) -> Node:
+    """Negate a value."""
+    if not isinstance(a, Node):
+        a = constant(a)
+    return _interned("neg", a)
+
+def recip(a: Any) -> Node:
+    """Reciprocal of a value."""
+    if not isinstance(a, Node):
+        a = constant(a)
+    return _interned("recip", a)
+
+def square(a: Any) -> Node:
+    """Square a value."""
+    if not isinstance(a, Node):
+        a = constant(a)
+    return _interned("square", a)
+
+def cube(a: Any) -> Node:
+    """Cube a value."""
+    if not isinstance(a, Node):
+        a = constant(a)
+    return _interned("cube", a)
+
+def topological_sort(node: Node, memoize: bool = False) -> List[Node]:
+    """
+    Return nodes in topologically sorted order.
+    
+    The order is computed with an explicit stack (no recursion limit on deep
+    graphs). With ``memoize`` it is cached on the root until any node's
+    inputs are reassigned, for roots that are sorted repeatedly (gradient
+    and compilation roots); caching on every sorted node would keep one
+    order per subgraph. The cache leaves out the root itself, so it does not
+    form a reference cycle with it.
+    
+    Args:
+        node (Node): The output node.
+        memoize (bool): Cache the order on ``node``.
+    
+    Returns:
+        List[Node]: Nodes in topological order.
+    """
+    cache = node._topo_cache
+    if cache is not None and cache[0] == Node._epoch:
+        return cache[1] + [node]
+
+    visited = {id(node): True}
+    order = []
+    stack = [(node, iter(node.inputs))]
+    while stack:
+        n, pending = stack[-1]
+        for inp in pending:
+            if id(inp) not in visited:
+                visited[id(inp)] = True
+                stack.append((inp, iter(inp.inputs)))
+                break
+        else:
+            stack.pop()
+            order.append(n)
+
+    if memoize:
+        node._topo_cache = (Node._epoch, order[:-1])
+    return order
+
+# Primitive operations shared by scalar and tensor evaluation.
+_OPS: Dict[str, Callable] = {
+    "add": operator.add,
+    "mul": operator.mul,
+    "div": operator.truediv,
+    "neg": operator.neg,
+    "recip": lambda a: 1.0 / a,
+    "square": lambda a: a * a,
+    "cube": lambda a: a * a * a,
+}
+
+def register_op(op: str, fn: Callable):
+    """
+    Register ``fn`` as the function evaluating nodes of operation ``op``.
+    
+    Registered operations are evaluated like the primitives, with tensor
+    inputs moved to the compute device first; the fusion pass registers its
+    fused operations this way.
+    """
+    _OPS[op] = fn
+
+def _apply(op: str, inputs: List[Any]) -> Any:
+    """Apply primitive ``op`` to already evaluated input values."""
+    fn = _OPS.get(op)
+    if fn is None:
+        raise ValueError(f"Unknown operation: {op}")
+
+    # Tensor inputs are moved to the compute device once (a no-op when they
+    # already live there); scalars broadcast against them as they are, and
+    # all-scalar inputs use plain Python arithmetic, so ints stay exact.
+    if any(isinstance(x, torch.Tensor) for x in inputs):
+        device = get_device()
+        inputs = [to_tensor(x, device) if isinstance(x, torch.Tensor) else x for x in inputs]
+    return fn(*inputs)
+
+def evaluate_all(sorted_nodes: List[Node], values: Optional[Dict[int, Any]] = None,
+                 skip_unknown: bool = False) -> Dict[int, Any]:
+    """
+    Evaluate every node of a topologically sorted graph in a single pass.
+    
+    Nodes that already hold a value keep it; every other node is computed once
+    from the values of its inputs. Values are returned rather than stored on
+    the nodes, so a graph can be re-evaluated after its leaf values change.
+    
+    Args:
+        sorted_nodes (List[Node]): Nodes in topological order.
+        values (Optional[Dict[int, Any]]): Values of inputs outside
+            ``sorted_nodes``, keyed by ``id(node)``; filled in place.
+        skip_unknown (bool): Leave nodes with an unknown operation, and the
+            nodes depending on them, out of the result instead of raising.
+    
+    Returns:
+        Dict[int, Any]: Computed values keyed by ``id(node)``.
+    
+    Raises:
+        ValueError: If a node has an unknown operation and ``skip_unknown``
+            is False.
+    """
+    if values is None:
+        values = {}
+    for n in sorted_nodes:
+        v = n.value
+        if v is None:
+            if skip_unknown and any(id(inp) not in values for inp in n.inputs):
+                continue
+            args = [values[id(inp)] for inp in n.inputs]
+            if n.op in _OPS:
+                v = _apply(n.op, args)
+            elif n._metadata and "fn" in n._metadata:
+                # Fused nodes carry their own function.
+                v = n._metadata["fn"](*args)
+            elif skip_unknown:
+                continue
+            else:
+                raise ValueError(f"Unknown operation: {n.op}")
+        values[id(n)] = v
+    return values
 
 def evaluate(node: Node) -> Any:
     """
@@ -107,34 +426,7 @@ def evaluate(node: Node) -> Any:
     """
     if node.value is not None:
         return node.value
-        
-    # Evaluate inputs
-    inputs = [evaluate(inp) for inp in node.inputs]
-    
-    # Convert inputs to tensors if any input is a tensor
-    has_tensor = any(isinstance(x, torch.Tensor) for x in inputs)
-    if has_tensor:
-        inputs = [torch.tensor(x, device='cpu') if not isinstance(x, torch.Tensor) else x.cpu() for x in inputs]
-        
-        # Use Metal operations for tensors
-        if node.op == "add":
-            return inputs[0] + inputs[1]
-        elif node.op == "mul":
-            return inputs[0] * inputs[1]
-        elif node.op == "div":
-            return inputs[0] / inputs[1]
-        else:
-            raise ValueError(f"Unknown operation: {node.op}")
-    else:
-        # Use regular Python operations for scalars
-        if node.op == "add":
-            return float(inputs[0] + inputs[1])
-        elif node.op == "mul":
-            return float(inputs[0] * inputs[1])
-        elif node.op == "div":
-            return float(inputs[0] / inputs[1])
-        else:
-            raise ValueError(f"Unknown operation: {node.op}")
+    return evaluate_all(topological_sort(node))[id(node)]
 
 def trace(node_or_value):
     """
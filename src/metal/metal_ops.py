@@ -6,13 +6,17 @@ Provides optimized Metal Performance Shaders (MPS) operations for Apple Silicon
 import torch
 import numpy as np
 
+# Probed once at import: torch.backends.mps.is_available() is not free.
+_DEVICE = torch.device("mps") if torch.backends.mps.is_available() else torch.device("cpu")
+
+# Operand types handled with plain Python arithmetic.
+_SCALAR_TYPES = (int, float)
+
 def get_device():
     """
     Get the appropriate device (MPS if available, else CPU).
     """
-    if torch.backends.mps.is_available():
-        return torch.device("mps")
-    return torch.device("cpu")
+    return _DEVICE
 
 def to_tensor(x, device=None):
     """
@@ -27,8 +31,14 @@ def to_tensor(x, device=None):
     """
     if device is None:
         device = get_device()
+    elif not isinstance(device, torch.device):
+        device = torch.device(device)
     
     if isinstance(x, torch.Tensor):
+        # Already on the target device (an unindexed device matches any of
+        # its indices): return it as is rather than dispatching through .to().
+        if x.device.type == device.type and device.index in (None, x.device.index):
+            return x
         return x.to(device)
     elif isinstance(x, np.ndarray):
         return torch.from_numpy(x).to(device)
@@ -44,8 +54,10 @@ def metal_add(a, b):
         b: Second operand (scalar, numpy array, or tensor)
     
     Returns:
-        torch.Tensor: Result of a + b
+        torch.Tensor: Result of a + b (a Python number if both operands are)
     """
+    if isinstance(a, _SCALAR_TYPES) and isinstance(b, _SCALAR_TYPES):
+        return a + b
     device = get_device()
     a_tensor = to_tensor(a, device)
     b_tensor = to_tensor(b, device)
@@ -60,8 +72,10 @@ def metal_mul(a, b):
         b: Second operand (scalar, numpy array, or tensor)
     
     Returns:
-        torch.Tensor: Result of a * b
+        torch.Tensor: Result of a * b (a Python number if both operands are)
     """
+    if isinstance(a, _SCALAR_TYPES) and isinstance(b, _SCALAR_TYPES):
+        return a * b
     device = get_device()
     a_tensor = to_tensor(a, device)
     b_tensor = to_tensor(b, device)
@@ -76,9 +90,122 @@ def metal_div(a, b):
         b: Second operand (scalar, numpy array, or tensor)
     
     Returns:
-        torch.Tensor: Result of a / b
+        torch.Tensor: Result of a / b (a Python number if both operands are)
     """
+    if isinstance(a, _SCALAR_TYPES) and isinstance(b, _SCALAR_TYPES):
+        return a / b
     device = get_device()
     a_tensor = to_tensor(a, device)
     b_tensor = to_tensor(b, device)
     return a_tensor / b_tensor
+
+# Fused multiply-add kernels: one dispatch and one rounding per element,
+# with the negated form free through metal::fma's signed operands. Half
+# tensors are loaded and stored as half but computed in float, so the
+# product is not rounded to half before the add.
+_FMA_SHADER = """
+#include <metal_stdlib>
+using namespace metal;
+
+#define FMA_KERNELS(T, ACC)                                                   \\
+kernel void fma_##T(device T* out [[buffer(0)]],                              \\
+                    constant T* a [[buffer(1)]],                              \\
+                    constant T* b [[buffer(2)]],                              \\
+                    constant T* c [[buffer(3)]],                              \\
+                    uint i [[thread_position_in_grid]]) {                     \\
+    out[i] = T(fma(ACC(a[i]), ACC(b[i]), ACC(c[i])));                         \\
+}                                                                             \\
+kernel void fnma_##T(device T* out [[buffer(0)]],                             \\
+                     constant T* a [[buffer(1)]],                             \\
+                     constant T* b [[buffer(2)]],                             \\
+                     constant T* c [[buffer(3)]],                             \\
+                     uint i [[thread_position_in_grid]]) {                    \\
+    out[i] = T(fma(-ACC(a[i]), ACC(b[i]), ACC(c[i])));                        \\
+}
+
+FMA_KERNELS(float, float)
+FMA_KERNELS(half, float)
+"""
+
+_KERNEL_TYPES = {torch.float32: "float", torch.float16: "half"}
+
+# The compiled shader library; None until first use, False if unavailable.
+_FMA_LIBRARY = None
+
+def _fma_kernel(name, a, b, c):
+    """
+    Return the Metal kernel ``name`` for the operand dtype, or None when the
+    operands are not same-shaped MPS tensors of a dtype the shader handles.
+    """
+    global _FMA_LIBRARY
+    if _DEVICE.type != "mps":
+        return None
+    if not all(isinstance(x, torch.Tensor) for x in (a, b, c)):
+        return None
+    dtype = a.dtype
+    if dtype not in _KERNEL_TYPES or b.dtype != dtype or c.dtype != dtype:
+        return None
+    if a.shape != b.shape or a.shape != c.shape or a.device.type != "mps":
+        return None
+    if _FMA_LIBRARY is None:
+        try:
+            _FMA_LIBRARY = torch.mps.compile_shader(_FMA_SHADER)
+        except Exception:
+            # Older PyTorch without compile_shader, or a failed compile.
+            _FMA_LIBRARY = False
+    if _FMA_LIBRARY is False:
+        return None
+    return getattr(_FMA_LIBRARY, f"{name}_{_KERNEL_TYPES[dtype]}")
+
+def _dispatch(kernel, a, b, c):
+    out = torch.empty_like(a, memory_format=torch.contiguous_format)
+    kernel(out, a.contiguous(), b.contiguous(), c.contiguous())
+    return out
+
+def fma(a, b, c):
+    """
+    Perform an element-wise fused multiply-add using Metal acceleration.
+    
+    Same-shaped float32/float16 MPS tensors run as one Metal ``fma`` kernel;
+    other tensors use ``torch.addcmul``.
+    
+    Args:
+        a: First factor (scalar, numpy array, or tensor)
+        b: Second factor (scalar, numpy array, or tensor)
+        c: Addend (scalar, numpy array, or tensor)
+    
+    Returns:
+        torch.Tensor: Result of a * b + c (a Python number if all operands are)
+    """
+    if isinstance(a, _SCALAR_TYPES) and isinstance(b, _SCALAR_TYPES) and isinstance(c, _SCALAR_TYPES):
+        return a * b + c
+    device = get_device()
+    a, b, c = to_tensor(a, device), to_tensor(b, device), to_tensor(c, device)
+    kernel = _fma_kernel("fma", a, b, c)
+    if kernel is not None:
+        return _dispatch(kernel, a, b, c)
+    return torch.addcmul(c, a, b)
+
+def fma_neg(a, b, c):
+    """
+    Perform an element-wise fused negated multiply-add using Metal acceleration.
+    
+    Same-shaped float32/float16 MPS tensors run as one Metal ``fma`` kernel;
+    other tensors use ``torch.addcmul``.
+    
+    Args:
+        a: First factor (scalar, numpy array, or tensor)
+        b: Second factor (scalar, numpy array, or tensor)
+        c: Addend (scalar, numpy array, or tensor)
+    
+    Returns:
+        torch.Tensor: Result of c - a * b (a Python number if all operands are)
+    """
+    if isinstance(a, _SCALAR_TYPES) and isinstance(b, _SCALAR_TYPES) and isinstance(c, _SCALAR_TYPES):
+        return c - a * b
+    device = get_device()
+    a, b, c = to_tensor(a, device), to_tensor(b, device), to_tensor(c, device)
+    kernel = _fma_kernel("fnma", a, b, c)
+    if kernel is not None:
+        return _dispatch(kernel, a, b, c)
+    return torch.addcmul(c, a, b, value=-1)
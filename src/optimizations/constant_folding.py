@@ -4,8 +4,22 @@ Implements constant folding and propagation optimization.
 """
 
 import logging
+import operator
+from functools import reduce
 import torch
 from ..core.tracer import Node, constant
+from ..core.autodiff import topological_sort
+
+# Operations folded when all of their inputs are constants.
+_FOLDABLE_OPS = {
+    "add": operator.add,
+    "mul": operator.mul,
+    "div": operator.truediv,
+    "neg": operator.neg,
+    "recip": lambda a: 1.0 / a,
+    "square": lambda a: a * a,
+    "cube": lambda a: a * a * a,
+}
 
 def optimize(graph: Node) -> Node:
     """
@@ -17,42 +31,49 @@ def optimize(graph: Node) -> Node:
     Returns:
         Node: The computation graph with constants folded.
     """
-    def helper(node: Node) -> Node:
-        # If already a constant, return as is
+    folded = {}
+    for node in topological_sort(graph):
+        # If already a constant, keep as is
         if node.op == "const":
-            return node
+            folded[id(node)] = node
+            continue
 
-        # Recursively optimize inputs
-        optimized_inputs = [helper(inp) for inp in node.inputs]
+        # Inputs were optimized before this node in topological order
+        optimized_inputs = [folded[id(inp)] for inp in node.inputs]
         node.inputs = optimized_inputs
+        folded[id(node)] = fold(node)
+
+    return folded[id(graph)]
 
-        # Check if all inputs are constants
-        if all(inp.op == "const" for inp in optimized_inputs):
-            values = [inp.value for inp in optimized_inputs]
-            try:
-                if node.op == "add":
-                    # Handle both scalar and tensor addition
-                    if any(isinstance(v, torch.Tensor) for v in values):
-                        folded_value = sum(torch.tensor(v) if not isinstance(v, torch.Tensor) else v for v in values)
-                    else:
-                        folded_value = sum(values)
-                    logging.info(f"Constant folding: Replacing add node with constant {folded_value}")
-                    return Node(op="const", value=folded_value)
-                elif node.op == "mul":
-                    # Handle both scalar and tensor multiplication
-                    folded_value = values[0]
-                    for v in values[1:]:
-                        if isinstance(folded_value, torch.Tensor) or isinstance(v, torch.Tensor):
-                            folded_value = torch.tensor(folded_value) * torch.tensor(v)
-                        else:
-                            folded_value *= v
-                    logging.info(f"Constant folding: Replacing mul node with constant {folded_value}")
-                    return Node(op="const", value=folded_value)
-                else:
-                    return node
-            except Exception as e:
-                logging.error(f"Error during constant folding: {e}")
-                return node
+def fold(node: Node) -> Node:
+    """Replace ``node`` with a constant if all of its inputs are constants."""
+    if not all(inp.op == "const" for inp in node.inputs):
+        return node
+    fn = _FOLDABLE_OPS.get(node.op)
+    if fn is None:
+        return node
+    values = [inp.value for inp in node.inputs]
+    try:
+        # Python arithmetic keeps all-int subgraphs exact: add/mul of ints
+        # stay int and only division promotes to float. Tensors combine with
+        # scalar operands directly, without wrapping them in new tensors.
+        folded_value = reduce(fn, values) if len(values) > 1 else fn(*values)
+        # Arguments are formatted only if INFO is enabled: a tensor's repr
+        # is expensive.
+        logging.info("Constant folding: Replacing %s node with constant %s", node.op, folded_value)
+        folded = Node(op="const", value=folded_value)
+        folded.dtype = _value_dtype(folded_value)
+        return folded
+    except Exception as e:
+        logging.error(f"Error during constant folding: {e}")
         return node
 
-    return helper(graph)
+def _value_dtype(value) -> torch.dtype:
+    """The torch dtype ``value`` computes in when it meets a tensor op."""
+    if isinstance(value, torch.Tensor):
+        return value.dtype
+    if isinstance(value, bool):
+        return torch.bool
+    if isinstance(value, int):
+        return torch.int64
+    return torch.get_default_dtype()
@@ -4,32 +4,224 @@ Implements Common Subexpression Elimination (CSE) optimization.
 """
 
 import logging
-from typing import Dict, Tuple
-from ..core.tracer import Node
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+from ..core.tracer import Node, add, mul
+from ..core.autodiff import topological_sort
+
+# Associative and commutative ops whose chains are flattened by two-term CSE.
+_ASSOCIATIVE_OPS = {"add": add, "mul": mul}
 
 def optimize(graph: Node) -> Node:
     """
     Perform common subexpression elimination on the computation graph.
     
+    Identical subexpressions are merged first; two-term extraction then
+    shares operand pairs repeated across differently associated add/mul
+    chains, and a final merge folds any terms that became identical.
+    
     Args:
         graph (Node): The root node of the computation graph.
     
     Returns:
         Node: The optimized computation graph.
     """
-    subexpr_map: Dict[Tuple, Node] = {}
+    graph = merge_identical(graph)
+    if extract_pairs(graph):
+        graph = merge_identical(graph)
+    return graph
+
+_MASK64 = (1 << 64) - 1
 
-    def helper(node: Node) -> Node:
+def _mix(x: int) -> int:
+    """splitmix64 finalizer: spreads consecutive node ids over 64 bits."""
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _MASK64
+    return x ^ (x >> 31)
+
+def _node_key(op: str, op_code: Optional[int], inputs: List[Node], value) -> int:
+    """
+    Integer key for an (op, inputs, value) triple.
+    
+    Each input's mixed id is shifted by its position, so the key depends on
+    operand order like the ops themselves. Ops without a code are keyed by
+    their string's hash. Keys can collide; callers confirm a match with
+    _same_node.
+    """
+    key = hash(op) if op_code is None else op_code << 64
+    for i, inp in enumerate(inputs):
+        key ^= _mix(inp.id) << i
+    if value is not None:
+        key ^= hash(value)
+    return key
+
+def _same_node(node: Node, op: str, inputs: List[Node], value) -> bool:
+    return (
+        node.op == op
+        and len(node.inputs) == len(inputs)
+        and all(a is b for a, b in zip(node.inputs, inputs))
+        and node.value is value
+    )
+
+def merge_identical(graph: Node) -> Node:
+    """
+    Merge structurally identical subexpressions.
+    
+    The add/mul/div factories already hash-cons their results, so this pass
+    only merges duplicates created directly through Node or by other passes.
+    
+    Args:
+        graph (Node): The root node of the computation graph.
+    
+    Returns:
+        Node: The optimized computation graph.
+    """
+    subexpr_map: Dict[int, Node] = {}
+    replaced: Dict[int, Node] = {}
+
+    for node in topological_sort(graph):
         if not node.inputs:
-            return node
-        new_inputs = [helper(inp) for inp in node.inputs]
-        key = (node.op, tuple(inp.id for inp in new_inputs), node.value)
-        if key in subexpr_map:
-            logging.info(f"CSE: Merging node {node} with existing node {subexpr_map[key]}")
-            return subexpr_map[key]
+            replaced[id(node)] = node
+            continue
+        new_inputs = [replaced[id(inp)] for inp in node.inputs]
+        key = _node_key(node.op, node.op_code, new_inputs, node.value)
+        existing = subexpr_map.get(key)
+        if existing is not None and _same_node(existing, node.op, new_inputs, node.value):
+            logging.info("CSE: Merging node %s with existing node %s", node, existing)
+            replaced[id(node)] = existing
         else:
             node.inputs = new_inputs
-            subexpr_map[key] = node
-            return node
+            # On a key collision the first node keeps the slot.
+            subexpr_map.setdefault(key, node)
+            replaced[id(node)] = node
+
+    return replaced[id(graph)]
+
+
+def _pair_key(op: str, a: Node, b: Node) -> Tuple[str, int, int]:
+    return (op, min(id(a), id(b)), max(id(a), id(b)))
+
+def _term_pairs(op: str, operands: List[Node], pair_nodes: Dict[Tuple, Tuple[Node, Node]]) -> Set[Tuple]:
+    """Return the distinct operand pairs of one flattened term."""
+    keys = set()
+    for i, a in enumerate(operands):
+        for b in operands[i + 1:]:
+            key = _pair_key(op, a, b)
+            keys.add(key)
+            pair_nodes.setdefault(key, (a, b))
+    return keys
+
+def _remove_once(operands: List[Node], node: Node) -> int:
+    for i, operand in enumerate(operands):
+        if operand is node:
+            del operands[i]
+            return i
+    raise ValueError(f"{node} is not an operand")
+
+def extract_pairs(graph: Node) -> bool:
+    """
+    Two-term common subexpression extraction, rewriting the graph in place.
+    
+    Maximal add/mul chains whose interior nodes have a single use are
+    flattened into operand lists. The operand pair shared by the most lists is
+    materialized once and substituted into each of them, repeating until no
+    pair occurs in more than one list; changed chains are then rebuilt.
+    Floating-point results may differ by rounding, as with any reassociation.
+    
+    Args:
+        graph (Node): The root node of the computation graph.
+    
+    Returns:
+        bool: True if any chain was rewritten.
+    """
+    nodes = topological_sort(graph)
+    uses: Dict[int, int] = {}
+    for node in nodes:
+        for inp in node.inputs:
+            uses[id(inp)] = uses.get(id(inp), 0) + 1
+
+    def is_chain(node: Node) -> bool:
+        return node.op in _ASSOCIATIVE_OPS and node.value is None and len(node.inputs) == 2
+
+    # Single-use chain nodes feeding a node of the same op are absorbed into it.
+    absorbed = set()
+    for node in nodes:
+        if is_chain(node):
+            for inp in node.inputs:
+                if inp.op == node.op and is_chain(inp) and uses[id(inp)] == 1:
+                    absorbed.add(id(inp))
+
+    roots: Dict[int, Node] = {}
+    terms: Dict[int, List[Node]] = {}
+    for node in nodes:
+        if is_chain(node) and id(node) not in absorbed:
+            operands = []
+            stack = list(reversed(node.inputs))
+            while stack:
+                operand = stack.pop()
+                if id(operand) in absorbed:
+                    stack.extend(reversed(operand.inputs))
+                else:
+                    operands.append(operand)
+            roots[id(node)] = node
+            terms[id(node)] = operands
+
+    pair_nodes: Dict[Tuple, Tuple[Node, Node]] = {}
+    term_pairs = {tid: _term_pairs(roots[tid].op, terms[tid], pair_nodes) for tid in terms}
+    counts: Counter = Counter()
+    for keys in term_pairs.values():
+        counts.update(keys)
+
+    changed = set()
+    rewired = False
+    while counts:
+        key, count = counts.most_common(1)[0]
+        if count < 2:
+            break
+        op, _, _ = key
+        a, b = pair_nodes[key]
+        holders = [tid for tid, keys in term_pairs.items() if key in keys]
+
+        # Reuse a chain that is exactly this pair; otherwise build the pair.
+        shared = None
+        for tid in holders:
+            if len(terms[tid]) == 2:
+                shared = roots[tid]
+                if tid in changed:
+                    shared.inputs = terms[tid]
+                    changed.discard(tid)
+                    rewired = True
+                counts.subtract(term_pairs.pop(tid))
+                del terms[tid]
+                break
+        if shared is None:
+            shared = _ASSOCIATIVE_OPS[op](a, b)
+
+        for tid in holders:
+            if tid not in terms:
+                continue
+            operands = terms[tid]
+            position = min(_remove_once(operands, a), _remove_once(operands, b))
+            operands.insert(position, shared)
+            changed.add(tid)
+            counts.subtract(term_pairs[tid])
+            term_pairs[tid] = _term_pairs(op, operands, pair_nodes)
+            counts.update(term_pairs[tid])
+        counts += Counter()  # Drop pairs whose count fell to zero
+
+    for tid in changed:
+        root = roots[tid]
+        operands = terms[tid]
+        if len(operands) == 1:
+            # The whole chain was shared; compute it from the shared node's inputs.
+            root.inputs = list(operands[0].inputs)
+            continue
+        factory = _ASSOCIATIVE_OPS[root.op]
+        left = operands[0]
+        for operand in operands[1:-1]:
+            left = factory(left, operand)
+        root.inputs = [left, operands[-1]]
 
-    return helper(graph)
+    if changed:
+        logging.info("CSE: Extracted shared operand pairs in %d chains", len(changed))
+    return rewired or bool(changed)
@@ -5,6 +5,7 @@ Implements Dead Code Elimination optimization.
 
 import logging
 from ..core.tracer import Node
+from ..core.autodiff import topological_sort
 
 def optimize(graph: Node) -> Node:
     """
@@ -16,15 +17,6 @@ def optimize(graph: Node) -> Node:
     Returns:
         Node: The computation graph (unchanged in structure for this demo).
     """
-    reachable = set()
-
-    def mark(node: Node):
-        if node.id in reachable:
-            return
-        reachable.add(node.id)
-        for inp in node.inputs:
-            mark(inp)
-
-    mark(graph)
+    reachable = {id(node) for node in topological_sort(graph)}
     logging.info("Dead code elimination: Completed marking reachable nodes.")
     return graph
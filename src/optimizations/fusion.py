@@ -4,19 +4,67 @@ Implements operation fusion optimization with hardware-specific patterns.
 """
 
 import logging
-from typing import List, Dict, Set, Tuple
-from ..core.tracer import Node
-from ..metal.metal_ops import get_device
-
-# Fusion patterns that can be efficiently executed on Metal
-METAL_FUSION_PATTERNS = {
-    ('mul', 'add'): 'fma',  # Fused multiply-add
-    ('mul', 'mul'): 'mul2',  # Consecutive multiplications
-    ('add', 'add'): 'add2',  # Consecutive additions
-    ('mul', 'div'): 'scale',  # Multiplication followed by division
+from collections import Counter
+from typing import Any, Callable, List, Dict, Optional, Set
+import torch
+from ..core import codegen
+from ..core.tracer import OP_CODES, Node, Op, register_op, topological_sort
+from ..metal.metal_ops import fma, fma_neg
+from .patterns import rewrite
+
+# Fusion patterns that can be efficiently executed on Metal, as
+# (op sequence from producer to consumer, fused op, score). A longer match
+# replaces more operations, and is scored higher.
+METAL_FUSION_PATTERNS = [
+    (('mul', 'add'), 'fma', 2),  # Fused multiply-add: a * b + c
+    (('mul', 'neg', 'add'), 'fnma', 3),  # Negated multiply-add: c - a * b
+    (('mul', 'add', 'add'), 'fma_add', 3),  # Multiply-add chain: a * b + c + d
+    (('mul', 'mul'), 'mul2', 2),  # Consecutive multiplications
+    (('add', 'add'), 'add2', 2),  # Consecutive additions
+    (('mul', 'div'), 'scale', 2),  # Multiplication followed by division
+]
+
+# Functions evaluating each fused op on the fused node's inputs, in the order
+# create_fused_op collects them. They are registered with the tracer, so
+# trace() dispatches fused nodes like the primitive ops.
+FUSED_OP_FNS: Dict[str, Callable] = {
+    'fma': fma,
+    'fnma': fma_neg,
+    'fma_add': lambda a, b, c, d: fma(a, b, c) + d,
+    'mul2': lambda a, b, c: a * b * c,
+    'add2': lambda a, b, c: a + b + c,
+    'scale': lambda a, b, c: a * b / c,
 }
+for _fused_type, _fn in FUSED_OP_FNS.items():
+    register_op(_fused_type, _fn)
+
+# METAL_FUSION_PATTERNS compiled into a trie of nested dicts keyed by op
+# code, so extending a partial match by one consumer is one int-keyed lookup.
+# A complete pattern stores its (fused op, score) under the _MATCH key, which
+# is no op code (nodes without a code have op_code None).
+_MATCH = -1
+_FUSE_TABLE: Dict[int, dict] = {}
+# Consumer op codes that may follow each producer op code in a pattern.
+_FUSE_EDGES: Dict[int, Set[int]] = {}
+for _sequence, _fused_type, _score in METAL_FUSION_PATTERNS:
+    _codes = [OP_CODES[_op] for _op in _sequence]
+    _trie = _FUSE_TABLE
+    for _code in _codes:
+        _trie = _trie.setdefault(_code, {})
+    _trie[_MATCH] = (_fused_type, _score)
+    for _first, _second in zip(_codes, _codes[1:]):
+        _FUSE_EDGES.setdefault(_first, set()).add(_second)
+
+# Consumer ops whose fused form needs the producer as their first operand.
+_ORDERED_OPS = {Op.DIV}
+
+# Partial matches kept per node by find_fusion_candidates.
+_TOP_K = 3
 
-def can_fuse(op1: Node, op2: Node) -> bool:
+# Elementwise operations that fuse_pointwise merges into a single region.
+POINTWISE_OPS = {"add", "mul", "div", "neg", "recip", "square", "cube"}
+
+def can_fuse(op1: Node, op2: Node, use_count: Optional[Dict[int, int]] = None) -> bool:
     """
     Determine if two operations can be fused based on operation type,
     hardware capabilities, and data dependencies.
@@ -24,24 +72,49 @@ def can_fuse(op1: Node, op2: Node) -> bool:
     Args:
         op1 (Node): First operation.
         op2 (Node): Second operation.
+        use_count (Optional[Dict[int, int]]): Number of consumers of each
+            node, keyed by ``id(node)``. When given, op1 must have no consumer besides
+            op2, since fusing it would otherwise duplicate its computation.
     
     Returns:
         bool: True if the operations can be fused.
     """
-    # Check if operations form a known fusion pattern
-    pattern = (op1.op, op2.op)
-    if pattern not in METAL_FUSION_PATTERNS:
+    # Check if operations form an edge of a known fusion pattern
+    successors = _FUSE_EDGES.get(op1.op_code)
+    if successors is None or op2.op_code not in successors:
         return False
-        
-    # Check data dependencies
-    if len(op2.inputs) != 2 or op1 not in op2.inputs:
+    
+    # A producer with other consumers must still be computed for them.
+    if use_count is not None and use_count[id(op1)] != 1:
         return False
         
-    # Check shapes if available
-    if 'shape' in op1.metadata and 'shape' in op2.metadata:
-        return op1.metadata['shape'] == op2.metadata['shape']
+    # Check data dependencies: op1 is used once by op2, as its first operand
+    # if op2 is not commutative.
+    inputs = op2.inputs
+    if len(inputs) == 1:
+        if inputs[0] is not op1:
+            return False
+    elif len(inputs) != 2 or (inputs[0] is op1) == (inputs[1] is op1):
+        return False
+    elif op2.op_code in _ORDERED_OPS and inputs[0] is not op1:
+        return False
         
-    return True
+    # Check shapes and dtypes if available: a fused kernel computes in one
+    # dtype.
+    if op1.dtype is not None and op2.dtype is not None and op1.dtype != op2.dtype:
+        return False
+    shape1 = op1.shape
+    shape2 = op2.shape
+    return shape1 is None or shape2 is None or shape1 == shape2
+
+def _match(ops: List[Node]):
+    """Return the (fused op, score) the op sequence of ``ops`` matches, or None."""
+    trie = _FUSE_TABLE
+    for op in ops:
+        trie = trie.get(op.op_code)
+        if trie is None:
+            return None
+    return trie.get(_MATCH)
 
 def create_fused_op(ops: List[Node]) -> Node:
     """
@@ -49,118 +122,306 @@ def create_fused_op(ops: List[Node]) -> Node:
     The fused operation will be optimized for the current hardware.
     
     Args:
-        ops (List[Node]): List of operations to fuse.
+        ops (List[Node]): Chain of operations to fuse, producer first.
     
     Returns:
-        Node: A new node representing the fused operation.
+        Node: A new node representing the fused operation, or the last node
+        of ``ops`` if they match no pattern.
     """
     if len(ops) < 2:
         return ops[0]
         
     # Identify the fusion pattern
-    pattern = tuple(op.op for op in ops[:2])
-    fused_type = METAL_FUSION_PATTERNS.get(pattern)
+    match = _match(ops)
     
-    if not fused_type:
-        return ops[0]
+    if not match:
+        return ops[-1]
         
-    # Create new node with fused operation
-    fused = Node(op=fused_type, inputs=ops[0].inputs + [inp for op in ops[1:] for inp in op.inputs if inp != ops[0]])
+    # Create new node with fused operation: the first op's inputs, then the
+    # other inputs of each later op. Inputs are positional, so one used twice
+    # (a * b + a) is passed twice rather than deduplicated.
+    inputs = list(ops[0].inputs)
+    for prev, op in zip(ops, ops[1:]):
+        inputs.extend(inp for inp in op.inputs if inp is not prev)
+    fused = Node(op=match[0], inputs=inputs)
     
     # Copy relevant metadata
     fused.metadata = {
+        'fn': FUSED_OP_FNS[match[0]],
         'fused_ops': [op.op for op in ops],
         'original_nodes': ops,
-        'shape': ops[0].metadata.get('shape'),
     }
+    fused.shape = ops[-1].shape
+    fused.dtype = ops[-1].dtype
     
     return fused
 
-def find_fusion_candidates(graph: Node) -> List[List[Node]]:
+def count_uses(graph: Node) -> Dict[int, int]:
+    """Return the number of consumers of each node in ``graph``, keyed by ``id(node)``."""
+    return Counter(id(inp) for node in topological_sort(graph) for inp in node.inputs)
+
+def _extend_matches(node: Node, partial: Dict[int, List], use_count: Optional[Dict[int, int]]) -> List[tuple]:
+    """
+    Extend the partial matches of ``node``'s producers by ``node``.
+    
+    Records the _TOP_K longest partial matches ending at ``node`` in
+    ``partial`` and returns the complete ones as (score, chain), highest
+    score first.
+    """
+    if not node.inputs or node.value is not None:
+        return []
+    matches = []
+    start = _FUSE_TABLE.get(node.op_code)
+    if start is not None:
+        matches.append((start, [node]))
+    for inp in node.inputs:
+        if not can_fuse(inp, node, use_count):
+            continue
+        for trie, chain in partial.get(id(inp), ()):
+            nxt = trie.get(node.op_code)
+            if nxt is not None:
+                matches.append((nxt, chain + [node]))
+    if not matches:
+        return []
+    matches.sort(key=lambda m: len(m[1]), reverse=True)
+    partial[id(node)] = matches[:_TOP_K]
+    complete = [(trie[_MATCH][1], chain) for trie, chain in matches if _MATCH in trie]
+    complete.sort(key=lambda m: m[0], reverse=True)
+    return complete
+
+def _claim(nodes: List[Node], complete: Dict[int, List[tuple]], use_count: Dict[int, int]) -> List[List[Node]]:
     """
-    Find sequences of operations that can be fused together.
+    Pick non-overlapping matches greedily from the output down, highest score
+    first, skipping chains whose inner nodes have other consumers.
+    """
+    candidates = []
+    claimed: Set[int] = set()
+    for node in reversed(nodes):
+        for _, chain in complete.get(id(node), ()):
+            if any(id(n) in claimed for n in chain):
+                continue
+            if any(use_count[id(n)] != 1 for n in chain[:-1]):
+                continue
+            claimed.update(id(n) for n in chain)
+            candidates.append(chain)
+            break
+    return candidates
+
+def find_fusion_candidates(graph: Node, use_count: Optional[Dict[int, int]] = None) -> List[List[Node]]:
+    """
+    Find chains of operations that can be fused together.
+    
+    Each node extends the partial pattern matches of its single-use
+    producers by its own op, keeping the _TOP_K longest. Complete matches are
+    then claimed greedily from the output down, highest score first, so the
+    returned groups do not overlap.
     
     Args:
         graph (Node): The root node of the computation graph.
+        use_count (Optional[Dict[int, int]]): Consumers per ``id(node)``, as
+            returned by count_uses; computed if not given.
         
     Returns:
-        List[List[Node]]: Lists of nodes that can be fused together.
+        List[List[Node]]: Chains of nodes (producer first) that can be fused
+        together.
     """
-    candidates = []
-    visited = set()
+    nodes = topological_sort(graph)
+    if use_count is None:
+        use_count = count_uses(graph)
     
-    def visit(node: Node):
-        if node.id in visited:
-            return
-        visited.add(node.id)
-        
-        # Check inputs for fusion opportunities
-        for inp in node.inputs:
-            visit(inp)
-            
-        # Try to build fusion groups starting at this node
-        if node.inputs:
-            group = [node]
-            current = node
-            while current.inputs and len(current.inputs) == 2:
-                prev = current.inputs[0]  # Assume first input is the main operation
-                if can_fuse(prev, current):
-                    group.insert(0, prev)
-                    current = prev
-                else:
-                    break
-            
-            if len(group) > 1:
-                candidates.append(group)
-    
-    visit(graph)
-    return candidates
+    # id(node) -> [(trie node, chain)] of partial matches ending at the node.
+    partial: Dict[int, List] = {}
+    complete: Dict[int, List[tuple]] = {}
+    for node in nodes:
+        matches = _extend_matches(node, partial, use_count)
+        if matches:
+            complete[id(node)] = matches
+    
+    return _claim(nodes, complete, use_count)
 
-def optimize(graph: Node) -> Node:
+try:
+    from torch._dynamo.exc import TorchDynamoException
+except ImportError:  # PyTorch without Dynamo: torch.compile is unavailable too.
+    TorchDynamoException = RuntimeError
+
+# Errors raised by torch.compile and its backends (Dynamo wraps Inductor's).
+_COMPILE_ERRORS = (TorchDynamoException,)
+
+class CompiledRegion:
     """
-    Fuse consecutive operations in the computation graph based on hardware-specific patterns.
+    The function of a fused pointwise region.
+    
+    Tensor arguments go through ``torch.compile``, so the whole region runs as
+    one elementwise kernel with its intermediates kept in registers. Scalars
+    call the generated Python function directly, and so does everything once
+    compilation has failed.
+    """
+
+    def __init__(self, fn: Callable):
+        self.fn = fn
+        self.compiled = None
+
+    def __call__(self, *args: Any) -> Any:
+        if not any(isinstance(arg, torch.Tensor) for arg in args):
+            return self.fn(*args)
+        if self.compiled is None:
+            self.compiled = torch.compile(self.fn, mode="reduce-overhead")
+        try:
+            return self.compiled(*args)
+        except _COMPILE_ERRORS as e:
+            # Dynamo also reports errors of the region itself (e.g. a shape
+            # mismatch) while tracing it: those raise again here, eagerly,
+            # and leave compilation on.
+            result = self.fn(*args)
+            logging.warning("torch.compile failed for %s, running eagerly: %s", self.fn.__name__, e)
+            self.compiled = self.fn
+            return result
+
+def _is_pointwise(node: Node) -> bool:
+    return node.op in POINTWISE_OPS and node.value is None
+
+def fuse_pointwise(graph: Node) -> Node:
+    """
+    Merge connected pointwise operations into single fused nodes.
+    
+    A pointwise node used only once, by another pointwise node, is absorbed
+    into its user's region; the remaining pointwise nodes are region outputs.
+    Each region with at least two operations becomes a
+    ``Node(op='fused', metadata={'fn': ...})`` whose inputs are the region's
+    free inputs, evaluating it in one call instead of one per operation.
     
     Args:
         graph (Node): The root node.
     
     Returns:
-        Node: The optimized computation graph.
+        Node: The graph with its pointwise regions fused.
     """
-    logging.info("Starting operation fusion optimization...")
+    nodes = topological_sort(graph)
+    uses = Counter(id(inp) for n in nodes for inp in n.inputs)
+    absorbed = set()
+    for n in nodes:
+        if _is_pointwise(n):
+            for inp in n.inputs:
+                if _is_pointwise(inp) and uses[id(inp)] == 1:
+                    absorbed.add(id(inp))
+
+    replacements: Dict[int, Node] = {}
+    for n in nodes:
+        if id(n) in absorbed:
+            continue
+        if not _is_pointwise(n) or not any(id(inp) in absorbed for inp in n.inputs):
+            # Not a region of two or more operations: only rewire its inputs.
+            new_inputs = [replacements.get(id(inp), inp) for inp in n.inputs]
+            n.inputs = new_inputs
+            continue
+
+        # Walk the region left to right, collecting its free inputs.
+        free: List[Node] = []
+        seen = set()
+        size = 1
+        stack = list(reversed(n.inputs))
+        while stack:
+            node = stack.pop()
+            if id(node) in absorbed:
+                size += 1
+                stack.extend(reversed(node.inputs))
+            elif id(node) not in seen:
+                seen.add(id(node))
+                free.append(node)
+
+        fn = codegen.generate(n, free, name=f"_fused{n.id}")
+        fused = Node(op="fused", inputs=[replacements.get(id(inp), inp) for inp in free])
+        fused.metadata = {
+            'fn': CompiledRegion(fn),
+            'fused_ops': size,
+        }
+        fused.shape = n.shape
+        fused.dtype = n.dtype
+        replacements[id(n)] = fused
+
+    return replacements.get(id(graph), graph)
+
+def optimize_pipeline(graph: Node) -> Node:
+    """
+    Simplify the graph and fuse its operation chains in one sweep.
     
-    # Find fusion candidates
-    fusion_groups = find_fusion_candidates(graph)
+    One bottom-up walk over the topological order rewires each node to its
+    rewritten inputs, folds and simplifies it (see patterns.rewrite), counts
+    the uses of the result and extends the fusion pattern matches ending at
+    it. Whether a chain's inner nodes are single-use is only known once the
+    walk is complete, so matches are claimed afterwards, and the fused nodes
+    are emitted in one pass over the rewritten nodes.
     
+    Args:
+        graph (Node): The root node.
+    
+    Returns:
+        Node: The simplified graph with its fusable chains fused.
+    """
+    rewritten: Dict[int, Node] = {}
+    # The rewritten graph in topological order: a rewrite's inputs are
+    # always rewritten nodes already emitted.
+    order: List[Node] = []
+    emitted: Set[int] = set()
+    use_count: Counter = Counter()
+    partial: Dict[int, List] = {}
+    complete: Dict[int, List[tuple]] = {}
+    for node in topological_sort(graph):
+        node.inputs = [rewritten[id(inp)] for inp in node.inputs]
+        result = rewrite(node)
+        rewritten[id(node)] = result
+        if id(result) in emitted:
+            continue
+        emitted.add(id(result))
+        order.append(result)
+        for inp in result.inputs:
+            use_count[id(inp)] += 1
+        # Use counts are not final yet; _claim checks them.
+        matches = _extend_matches(result, partial, None)
+        if matches:
+            complete[id(result)] = matches
+    root = rewritten[id(graph)]
+
+    fusion_groups = _claim(order, complete, use_count)
     if not fusion_groups:
-        return graph
-        
-    # Create a mapping from old nodes to their fused replacements
-    replacements = {}
-    for group in fusion_groups:
-        fused = create_fused_op(group)
-        for old_node in group:
-            replacements[old_node.id] = fused
-            
-    # Create a new graph with fused operations
-    def replace_node(node: Node, visited: Set[str]) -> Node:
-        if node.id in visited:
-            return replacements.get(node.id, node)
-            
-        visited.add(node.id)
-        
-        if node.id in replacements:
-            return replacements[node.id]
-            
-        # Recursively replace inputs
-        new_inputs = [replace_node(inp, visited) for inp in node.inputs]
-        if new_inputs != node.inputs:
+        return root
+
+    # Map each group's output to its fused replacement. Every other node of a
+    # group is single-use, so nothing outside the group refers to it.
+    replacements = {id(group[-1]): create_fused_op(group) for group in fusion_groups}
+    memo: Dict[int, Node] = {}
+    for node in order:
+        if id(node) in replacements:
+            fused = replacements[id(node)]
+            fused.inputs = [memo[id(inp)] for inp in fused.inputs]
+            memo[id(node)] = fused
+            continue
+        new_inputs = [memo[id(inp)] for inp in node.inputs]
+        if any(new is not old for new, old in zip(new_inputs, node.inputs)):
             new_node = Node(op=node.op, inputs=new_inputs)
-            new_node.metadata = node.metadata.copy()
-            return new_node
-            
-        return node
-        
-    optimized = replace_node(graph, set())
+            if node._metadata:
+                new_node.metadata = node._metadata.copy()
+            new_node.shape = node.shape
+            new_node.dtype = node.dtype
+            memo[id(node)] = new_node
+        else:
+            memo[id(node)] = node
+
+    logging.info("Operation fusion complete. Found %d fusion opportunities.", len(fusion_groups))
+    return memo[id(root)]
+
+def optimize(graph: Node) -> Node:
+    """
+    Fuse consecutive operations in the computation graph based on hardware-specific patterns.
     
-    logging.info(f"Operation fusion complete. Found {len(fusion_groups)} fusion opportunities.")
-    return optimized
\ No newline at end of file
+    The pattern-based fusion runs as one sweep (optimize_pipeline); the
+    remaining pointwise regions are then merged by fuse_pointwise.
+    
+    Args:
+        graph (Node): The root node.
+    
+    Returns:
+        Node: The optimized computation graph.
+    """
+    logging.info("Starting operation fusion optimization...")
+    return fuse_pointwise(optimize_pipeline(graph))
@@ -0,0 +1,108 @@
+"""
+Module: numba_backend.py
+Lowers scalar computation graphs to flat op-code arrays evaluated by a Numba kernel.
+"""
+
+from typing import Any, List
+import numpy as np
+import torch
+from ..core.tracer import Node, Op, topological_sort
+
+try:
+    from numba import njit
+except ImportError:  # Numba is optional; fall back to the same loop in Python.
+    njit = None
+
+# Op codes understood by the kernel: the tracer's codes, as plain ints for
+# the compiled loop.
+OP_CONST = int(Op.CONST)
+OP_ADD = int(Op.ADD)
+OP_MUL = int(Op.MUL)
+OP_DIV = int(Op.DIV)
+OP_NEG = int(Op.NEG)
+OP_RECIP = int(Op.RECIP)
+OP_SQUARE = int(Op.SQUARE)
+OP_CUBE = int(Op.CUBE)
+
+# Number of inputs each op code reads.
+_ARITY = {op: 2 for op in (OP_ADD, OP_MUL, OP_DIV)}
+_ARITY.update({op: 1 for op in (OP_NEG, OP_RECIP, OP_SQUARE, OP_CUBE)})
+_ARITY[OP_CONST] = 0
+
+def _run(ops, lhs, rhs, consts):
+    v = np.empty_like(consts)
+    for i in range(ops.shape[0]):
+        op = ops[i]
+        if op == OP_CONST:
+            v[i] = consts[i]
+        elif op == OP_ADD:
+            v[i] = v[lhs[i]] + v[rhs[i]]
+        elif op == OP_MUL:
+            v[i] = v[lhs[i]] * v[rhs[i]]
+        elif op == OP_DIV:
+            v[i] = v[lhs[i]] / v[rhs[i]]
+        elif op == OP_NEG:
+            v[i] = -v[lhs[i]]
+        elif op == OP_RECIP:
+            v[i] = 1.0 / v[lhs[i]]
+        elif op == OP_SQUARE:
+            v[i] = v[lhs[i]] * v[lhs[i]]
+        else:
+            v[i] = v[lhs[i]] * v[lhs[i]] * v[lhs[i]]
+    return v[-1]
+
+if njit is not None:
+    _run = njit(cache=True)(_run)
+
+class ScalarKernel:
+    """
+    A scalar graph encoded as op-code arrays in topological order.
+
+    Constant leaves are the kernel's inputs: calling the kernel reads their
+    current values (or the values passed in, in ``leaves`` order), so the
+    same kernel is reused as leaf values change.
+    """
+
+    def __init__(self, graph: Node):
+        nodes = topological_sort(graph)
+        position = {id(n): i for i, n in enumerate(nodes)}
+        self.ops = np.empty(len(nodes), dtype=np.int32)
+        self.lhs = np.zeros(len(nodes), dtype=np.int32)
+        self.rhs = np.zeros(len(nodes), dtype=np.int32)
+        self.leaves: List[Node] = []
+        leaf_index = []
+        for i, n in enumerate(nodes):
+            op = n.op_code
+            if op not in _ARITY or len(n.inputs) != _ARITY[op]:
+                raise ValueError(f"Numba backend cannot lower operation: {n.op}")
+            self.ops[i] = op
+            if op == OP_CONST:
+                self.leaves.append(n)
+                leaf_index.append(i)
+            else:
+                self.lhs[i] = position[id(n.inputs[0])]
+                self.rhs[i] = position[id(n.inputs[-1])]
+        self.leaf_index = np.array(leaf_index, dtype=np.int64)
+        self._consts = np.zeros(len(nodes), dtype=np.float64)
+
+    def __call__(self, *leaf_values: Any) -> float:
+        if not leaf_values:
+            leaf_values = [leaf.value for leaf in self.leaves]
+        elif len(leaf_values) != len(self.leaves):
+            raise ValueError(f"Expected {len(self.leaves)} leaf values, got {len(leaf_values)}")
+        if any(isinstance(v, torch.Tensor) for v in leaf_values):
+            raise TypeError("Numba backend only evaluates scalar graphs")
+        self._consts[self.leaf_index] = leaf_values
+        return float(_run(self.ops, self.lhs, self.rhs, self._consts))
+
+def lower(graph: Node) -> ScalarKernel:
+    """
+    Lower a scalar arithmetic graph to a Numba-compiled kernel.
+
+    Args:
+        graph (Node): The root of the computation graph.
+
+    Returns:
+        ScalarKernel: Callable evaluating the graph on its leaf values.
+    """
+    return ScalarKernel(graph)
@@ -3,30 +3,130 @@ Module: patterns.py
 Defines a simple pattern matching system for algebraic simplifications.
 """
 
-from typing import Callable
-from src.core.tracer import Node, constant
+from collections import defaultdict
+from typing import Callable, Dict, List
+from ..core.tracer import OP_CODES, Node, Op, constant, cube, neg, recip, square, topological_sort
+from .constant_folding import fold
 
 class Pattern:
-    def __init__(self, match_fn: Callable[[Node], bool], replace_fn: Callable[[Node], Node]):
+    def __init__(self, op_target: str, match_fn: Callable[[Node], bool], replace_fn: Callable[[Node], Node]):
         """
         Initialize a pattern with a matching function and a replacement function.
         
         Args:
+            op_target (str): The operation of the nodes this pattern can match.
             match_fn (Callable[[Node], bool]): Returns True if the node matches the pattern.
             replace_fn (Callable[[Node], Node]): Returns the replacement node.
         """
+        self.op_target = op_target
         self.match = match_fn
         self.replace = replace_fn
 
+def _is_scalar(node: Node, value: float) -> bool:
+    """True if ``node`` is a scalar constant equal to ``value``."""
+    return node.op_code == Op.CONST and type(node.value) in (int, float) and node.value == value
+
+def _other(n: Node, value: float) -> Node:
+    """The input of binary node ``n`` that is not the constant ``value``."""
+    a, b = n.inputs
+    return b if _is_scalar(a, value) else a
+
+def _cube_base(n: Node):
+    """Return x if ``n`` is x * square(x) or square(x) * x, else None."""
+    a, b = n.inputs
+    if b.op_code == Op.SQUARE and b.inputs[0] is a:
+        return a
+    if a.op_code == Op.SQUARE and a.inputs[0] is b:
+        return b
+    return None
+
 patterns = [
     # Simplify: x * 0 = 0
     Pattern(
-        match_fn=lambda n: n.op == 'mul' and any(i.value == 0 for i in n.inputs if i.value is not None),
+        op_target='mul',
+        match_fn=lambda n: any(_is_scalar(i, 0) for i in n.inputs),
         replace_fn=lambda n: constant(0)
     ),
     # Simplify: x * 1 = x (assuming one non-one input)
     Pattern(
-        match_fn=lambda n: n.op == 'mul' and any(i.value == 1 for i in n.inputs if i.value is not None),
-        replace_fn=lambda n: next(i for i in n.inputs if i.value != 1)
-    )
-]
\ No newline at end of file
+        op_target='mul',
+        match_fn=lambda n: any(_is_scalar(i, 1) for i in n.inputs),
+        replace_fn=lambda n: _other(n, 1)
+    ),
+    # Simplify: x + 0 = x
+    Pattern(
+        op_target='add',
+        match_fn=lambda n: any(_is_scalar(i, 0) for i in n.inputs),
+        replace_fn=lambda n: _other(n, 0)
+    ),
+    # Simplify: x / 1 = x
+    Pattern(
+        op_target='div',
+        match_fn=lambda n: _is_scalar(n.inputs[1], 1),
+        replace_fn=lambda n: n.inputs[0]
+    ),
+    # Simplify: -1 * x = neg(x)
+    Pattern(
+        op_target='mul',
+        match_fn=lambda n: any(_is_scalar(i, -1) for i in n.inputs),
+        replace_fn=lambda n: neg(_other(n, -1))
+    ),
+    # Simplify: x * x = square(x)
+    Pattern(
+        op_target='mul',
+        match_fn=lambda n: n.inputs[0] is n.inputs[1],
+        replace_fn=lambda n: square(n.inputs[0])
+    ),
+    # Simplify: x * square(x) = cube(x)
+    Pattern(
+        op_target='mul',
+        match_fn=lambda n: _cube_base(n) is not None,
+        replace_fn=lambda n: cube(_cube_base(n))
+    ),
+    # Simplify: 1 / x = recip(x)
+    Pattern(
+        op_target='div',
+        match_fn=lambda n: _is_scalar(n.inputs[0], 1),
+        replace_fn=lambda n: recip(n.inputs[1])
+    ),
+]
+
+# Patterns bucketed by the code of the operation they match, so each node is
+# only checked against the patterns that can apply to it.
+PATTERNS_BY_OP: Dict[int, List[Pattern]] = defaultdict(list)
+for _pattern in patterns:
+    PATTERNS_BY_OP[OP_CODES[_pattern.op_target]].append(_pattern)
+
+def rewrite(node: Node) -> Node:
+    """Fold ``node`` or apply patterns to it until neither changes it."""
+    while True:
+        result = fold(node)
+        if result is node:
+            for pattern in PATTERNS_BY_OP.get(node.op_code, ()):
+                if pattern.match(node):
+                    result = pattern.replace(node)
+                    break
+        if result is node:
+            return node
+        node = result
+
+def simplify(graph: Node) -> Node:
+    """
+    Fold constants and apply the algebraic patterns until a fixed point.
+    
+    The graph is rewritten bottom-up and each node is rewritten until
+    nothing applies, after its inputs have reached their own fixed points,
+    so one sweep simplifies the whole graph.
+    
+    Args:
+        graph (Node): The root node.
+    
+    Returns:
+        Node: The simplified graph.
+    """
+    rewritten = {}
+    for node in topological_sort(graph):
+        new_inputs = [rewritten[id(inp)] for inp in node.inputs]
+        node.inputs = new_inputs
+        rewritten[id(node)] = rewrite(node)
+    return rewritten[id(graph)]
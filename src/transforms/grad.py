@@ -3,12 +3,226 @@ Module: grad.py
 Gradient transformation, similar to JAX's grad.
 """
 
-from typing import Callable, Any, Optional
-from .transform_base import Transform
-from ..core.tracer import Node, constant, trace
-from ..core.autodiff import compute_gradients
+import math
+from typing import Callable, Any, Dict, List, Optional, Tuple
+from .transform_base import Transform, arg_kind
+from ..core.tracer import Node, Tape, constant, evaluate_all, topological_sort, trace
+from ..core.autodiff import compute_gradients, has_vjp, tape_gradients
 import torch
 
+# Most recorded tapes kept per transformed function; the oldest is dropped
+# first. Each distinct static argument value records its own tape.
+_MAX_TAPES = 64
+
+_NODE_VALUE = Node.value
+
+class _TracedArg(Node):
+    """
+    A differentiated argument while it is traced.
+    
+    Reading its value while ``watched`` sets ``read``: the trace depends on
+    the argument's value (e.g. Python control flow on it), so its tape is not
+    valid for other values.
+    """
+
+    __slots__ = ('watched', 'read')
+
+    def __init__(self, value: Any):
+        super().__init__(op='const', value=value)
+        self.watched = True
+        self.read = False
+
+    @property
+    def value(self) -> Any:
+        if self.watched:
+            self.read = True
+        return _NODE_VALUE.__get__(self)
+
+    @value.setter
+    def value(self, value: Any):
+        _NODE_VALUE.__set__(self, value)
+
+class GradTape:
+    """
+    A traced function's recorded tape, replayed for new argument values.
+    
+    The forward pass evaluates the tape in recording order and the backward
+    pass scans it in reverse, so neither walks the graph. Nodes the tape reads
+    but did not record (built before tracing, so independent of the
+    arguments) are re-evaluated on every run, so updates to their leaf
+    values (e.g. parameters) are seen.
+    """
+
+    def __init__(self, tape: Tape, output: Node, aux: Any, inputs: List[Node]):
+        """
+        Raises:
+            ValueError: If the tape cannot be replayed: it does not contain
+                the output, contains an op without a derivative, or reads a
+                node it did not record that depends on the inputs (e.g. one
+                built directly with Node).
+        """
+        self.nodes = tape.nodes
+        self.output = output
+        self.aux = aux
+        self.inputs = inputs
+        self.recorded = {id(n) for n in self.nodes}
+        if id(output) not in self.recorded:
+            raise ValueError("The output was not recorded on the tape")
+        for n in self.nodes:
+            if not has_vjp(n):
+                raise ValueError(f"No derivative for operation: {n.op}")
+        input_ids = {id(n) for n in inputs}
+        # Subgraphs of the unrecorded nodes, in topological order
+        self.external: List[Node] = []
+        seen = set()
+        for n in self.nodes:
+            for inp in n.inputs:
+                if id(inp) in self.recorded or id(inp) in seen:
+                    continue
+                order = topological_sort(inp)
+                if any(id(m) in input_ids for m in order):
+                    raise ValueError(f"Unrecorded node depends on the inputs: {inp}")
+                for m in order:
+                    if id(m) not in seen:
+                        seen.add(id(m))
+                        self.external.append(m)
+
+    def run(self, arg_values: List[Any]) -> Tuple[Any, List[Any], Any]:
+        """
+        Evaluate the tape on new argument values.
+        
+        Returns:
+            Tuple[Any, List[Any], Any]: The output value, the gradient with
+            respect to each input, and the auxiliary value.
+        
+        Raises:
+            ValueError: If the output depends on an op without a derivative.
+        """
+        for node, value in zip(self.inputs, arg_values):
+            node.value = value
+        values = evaluate_all(self.nodes, evaluate_all(self.external))
+        grads = tape_gradients(self.nodes, self.output, values)
+        input_grads = []
+        for node in self.inputs:
+            g = grads.get(id(node))
+            if g is None:
+                # The output does not depend on this input.
+                g = torch.zeros_like(node.value) if isinstance(node.value, torch.Tensor) else 0.0
+            input_grads.append(g)
+        aux = trace(self.aux) if isinstance(self.aux, Node) else self.aux
+        return values[id(self.output)], input_grads, aux
+
+def _tape_key(args: tuple, kwargs: dict, argnums: Tuple[int, ...]) -> Optional[tuple]:
+    """
+    Cache key for a recorded tape, or None if the trace cannot be reused.
+    
+    Differentiated arguments contribute their kind (shape, dtype and device
+    for tensors); every other argument is baked into the trace, so scalars
+    contribute their value and tensors or nodes prevent caching, as
+    positional or keyword arguments. NaN never equals a later NaN, so it
+    prevents caching too.
+    """
+    for v in kwargs.values():
+        if isinstance(v, (Node, torch.Tensor)):
+            # They hash by identity: every new one would add a tape.
+            return None
+        if isinstance(v, float) and math.isnan(v):
+            return None
+    parts = []
+    for i, arg in enumerate(args):
+        if isinstance(arg, Node):
+            return None
+        if i in argnums:
+            parts.append(arg_kind(arg))
+        elif isinstance(arg, torch.Tensor) or (isinstance(arg, float) and math.isnan(arg)):
+            return None
+        else:
+            parts.append(('V', type(arg), arg))
+    key = tuple(parts)
+    if kwargs:
+        key += tuple(sorted(kwargs.items()))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+def _value_and_grads(fn: Callable, args: tuple, kwargs: dict, argnums: Tuple[int, ...],
+                     has_aux: bool, tapes: Dict[tuple, GradTape],
+                     need_value: bool = True) -> Tuple[Any, List[Any], Any]:
+    """
+    Evaluate ``fn`` and its gradients with respect to the ``argnums`` arguments.
+    
+    The tape recorded while tracing is cached in ``tapes`` by argument kind,
+    so repeated calls skip the trace, keeping at most ``_MAX_TAPES``. A trace
+    that reads the value of a differentiated argument (branching on it, or
+    evaluating a node built from it) is not cached, since the tape only holds
+    the branch taken for that value. Graphs the tape cannot differentiate
+    fall back to compute_gradients, which also handles custom nodes with a
+    ``grad_fn``; without ``need_value`` they need no evaluator there.
+    
+    Returns:
+        Tuple[Any, List[Any], Any]: The value, the gradient for each of
+        ``argnums`` and the auxiliary value (None without ``has_aux``). The
+        value is None from the fallback path when ``need_value`` is False.
+    """
+    key = _tape_key(args, kwargs, argnums)
+    tape = tapes.get(key) if key is not None else None
+    if tape is not None:
+        return tape.run([args[i] for i in argnums])
+
+    # Convert inputs to nodes and run the function to build the computation
+    # graph, recording it on a tape
+    with Tape() as recorded:
+        traced_args = []
+        for i, arg in enumerate(args):
+            if i in argnums and not isinstance(arg, Node):
+                node = _TracedArg(arg)
+                recorded.nodes.append(node)
+                traced_args.append(node)
+            else:
+                traced_args.append(arg)
+        output = fn(*traced_args, **kwargs)
+    value_dependent = False
+    for node in traced_args:
+        if isinstance(node, _TracedArg):
+            node.watched = False
+            value_dependent = value_dependent or node.read
+
+    aux = None
+    if has_aux:
+        output, aux = output
+
+    # Node arguments may reach the output through nodes built before the
+    # trace, which the tape did not record.
+    if isinstance(output, Node) and not any(isinstance(arg, Node) for arg in args):
+        inputs = [traced_args[i] for i in argnums]
+        try:
+            tape = GradTape(recorded, output, aux, inputs)
+            result = tape.run([node.value for node in inputs])
+        except ValueError:
+            # e.g. custom nodes with a grad_fn, which the tape does not
+            # record: use the general reverse pass
+            pass
+        else:
+            if key is not None and not value_dependent:
+                tapes[key] = tape
+                if len(tapes) > _MAX_TAPES:
+                    del tapes[next(iter(tapes))]
+            return result
+
+    aux_value = trace(aux) if isinstance(aux, Node) else aux
+    # If output is a Tensor, wrap it in a Node
+    if isinstance(output, torch.Tensor):
+        output = Node(op='grad_output', inputs=traced_args, value=output)
+    value = trace(output) if need_value else None
+    compute_gradients(output)
+    # The gradient buffers are reused by the next compute_gradients call on
+    # the same nodes.
+    grads = [traced_args[i].grad for i in argnums]
+    grads = [g.clone() if isinstance(g, torch.Tensor) else g for g in grads]
+    return value, grads, aux_value
+
 def grad(fn: Callable = None, argnums: Any = 0, has_aux: bool = False):
     """
     Gradient transformation.
@@ -32,40 +246,17 @@ def grad(fn: Callable = None, argnums: Any = 0, has_aux: bool = False):
             super().__init__(fn)
             self.argnums = argnums
             self.has_aux = has_aux
+            # Recorded tapes, keyed by argument kinds and static arguments
+            self.tapes: Dict[tuple, GradTape] = {}
             
         def transform(self, fn: Callable) -> Callable:
             def wrapped(*args, **kwargs):
-                # Convert inputs to nodes
-                traced_args = []
-                for i, arg in enumerate(args):
-                    if i in self.argnums:
-                        if isinstance(arg, Node):
-                            traced_args.append(arg)
-                        else:
-                            traced_args.append(constant(arg))
-                    else:
-                        traced_args.append(arg)
-                        
-                # Run the function to build the computation graph
-                output = fn(*traced_args, **kwargs)
-                
-                if self.has_aux:
-                    output, aux = output
-                    aux_value = trace(aux) if isinstance(aux, Node) else aux
-                
-                # If output is a Tensor, wrap it in a Node
-                if isinstance(output, torch.Tensor):
-                    output = Node(op='grad_output', inputs=traced_args, value=output)
-                
-                # Compute gradients
-                compute_gradients(output)
+                _, grads, aux_value = _value_and_grads(
+                    fn, args, kwargs, self.argnums, self.has_aux, self.tapes,
+                    need_value=False)
                 
                 # Extract gradients for the specified arguments
-                if len(self.argnums) == 1:
-                    result = traced_args[self.argnums[0]].grad
-                else:
-                    result = tuple(traced_args[i].grad for i in self.argnums)
-                    
+                result = grads[0] if len(self.argnums) == 1 else tuple(grads)
                 if self.has_aux:
                     return result, aux_value
                 return result
@@ -87,35 +278,16 @@ def value_and_grad(fn: Callable, argnums: Any = 0, has_aux: bool = False):
     Returns:
         A function that returns a tuple (value, gradient).
     """
+    argnums_tuple = (argnums,) if isinstance(argnums, int) else tuple(argnums)
+    # Recorded tapes, keyed by argument kinds and static arguments
+    tapes: Dict[tuple, GradTape] = {}
     
     def wrapped(*args, **kwargs):
-        # Convert inputs to Node objects
-        traced_args = []
-        for i, arg in enumerate(args):
-            if i in ((argnums,) if isinstance(argnums, int) else argnums):
-                traced_args.append(constant(arg))
-            else:
-                traced_args.append(arg)
-                
-        # Run the function to build the computation graph
-        output = fn(*traced_args, **kwargs)
-        
-        if has_aux:
-            output, aux = output
-            aux_value = trace(aux) if isinstance(aux, Node) else aux
-            
-        # Get the value before computing gradients
-        value = trace(output)
-        
-        # Compute gradients
-        compute_gradients(output)
+        value, grads, aux_value = _value_and_grads(
+            fn, args, kwargs, argnums_tuple, has_aux, tapes)
         
         # Extract gradients
-        if isinstance(argnums, int):
-            grad_output = traced_args[argnums].grad
-        else:
-            grad_output = tuple(traced_args[i].grad for i in argnums)
-            
+        grad_output = grads[0] if isinstance(argnums, int) else tuple(grads)
         if has_aux:
             return (value, grad_output), aux_value
         return value, grad_output
@@ -3,24 +3,42 @@ Module: jit.py
 Just-In-Time compilation transformation, similar to JAX's jit.
 """
 
-from typing import Callable, Any, Dict, List
+from typing import Callable, Any, Dict, List, Optional
 import torch
-from .transform_base import Transform
+from .transform_base import Transform, arg_kind
 from ..core.tracer import Node, constant, trace
+from ..core import codegen
 from ..metal.metal_ops import get_device, to_tensor
 
 class CachedGraph:
-    """Represents a cached computation graph for reuse."""
+    """
+    Represents a cached computation graph for reuse.
+    
+    The graph is compiled once into a straight-line Python function of its
+    inputs, so calls run no interpreter over the graph.
+    """
     def __init__(self, output_node: Node, input_nodes: List[Node]):
         self.output_node = output_node
         self.input_nodes = input_nodes
-        self.compiled_fn = None
+        self.compiled_fn = codegen.generate(output_node, input_nodes)
         
     def __call__(self, *args):
-        # Update input values
-        for node, arg in zip(self.input_nodes, args):
-            node.value = arg
-        return trace(self.output_node)
+        return self.compiled_fn(*[trace(arg) if isinstance(arg, Node) else arg for arg in args])
+
+def _make_cache_key(args: tuple, kwargs: dict) -> Optional[tuple]:
+    """
+    Create a cache key based on input types and tensor shapes.
+    
+    Keyword arguments are traced as static values, so their values are part
+    of the key; it is unhashable if one of them is. Tensor and Node keyword
+    arguments hash by identity, so calls with them are not cached (None).
+    """
+    if any(isinstance(v, (Node, torch.Tensor)) for v in kwargs.values()):
+        return None
+    key = tuple(arg_kind(arg) for arg in args)
+    if kwargs:
+        key += tuple(sorted(kwargs.items()))
+    return key
 
 class jit(Transform):
     """
@@ -44,10 +62,16 @@ class jit(Transform):
         
     def transform(self, fn: Callable) -> Callable:
         def wrapped(*args, **kwargs):
-            # Create a cache key based on input types
-            cache_key = tuple(type(arg) for arg in args)
+            cache_key = _make_cache_key(args, kwargs)
+            cached = None
+            if cache_key is not None:
+                try:
+                    cached = self.cache.get(cache_key)
+                except TypeError:
+                    # Unhashable keyword argument: trace without caching
+                    cache_key = None
             
-            if cache_key not in self.cache:
+            if cached is None:
                 # First call: build and cache the computation graph
                 traced_args = []
                 for arg in args:
@@ -57,43 +81,14 @@ class jit(Transform):
                         traced_args.append(constant(arg))
                         
                 output = fn(*traced_args, **kwargs)
-                self.cache[cache_key] = lambda *args: output
+                if not isinstance(output, Node):
+                    # Nothing was traced, so there is no graph to reuse
+                    return output
+                cached = CachedGraph(output, traced_args)
+                if cache_key is not None:
+                    self.cache[cache_key] = cached
                 
             # Use the cached graph
-            result = self.cache[cache_key](*args)
-            
-            # If the result is a Node, evaluate it
-            if isinstance(result, Node):
-                return trace(result)
-            return result
+            return cached(*args)
             
         return wrapped
-
-class CachedGraph:
-    """Represents a cached computation graph for reuse."""
-    def __init__(self, output_node: Node, input_nodes: List[Node]):
-        self.output_node = output_node
-        self.input_nodes = input_nodes
-        self.compiled_fn = None
-        
-    def __call__(self, *args):
-        # Update input values
-        for node, arg in zip(self.input_nodes, args):
-            node.value = arg
-        return trace(self.output_node)
-
-    def _make_cache_key(self, args, kwargs) -> str:
-        """Create a cache key based on input shapes and types."""
-        key_parts = []
-        for arg in args:
-            if isinstance(arg, (int, float)):
-                key_parts.append(f"scalar_{type(arg).__name__}")
-            elif isinstance(arg, torch.Tensor):
-                key_parts.append(f"tensor_{list(arg.shape)}_{arg.dtype}")
-            else:
-                key_parts.append(f"other_{type(arg).__name__}")
-        
-        for k, v in sorted(kwargs.items()):
-            key_parts.append(f"{k}_{type(v).__name__}")
-            
-        return "_".join(key_parts)
@@ -6,8 +6,15 @@ Base classes and utilities for JAX-style function transformations.
 from typing import Callable, Any, Tuple, List, Dict
 from functools import wraps
 import inspect
+import torch
 from ..core.tracer import Node, constant, trace
 
+def arg_kind(arg: Any) -> tuple:
+    """Trace cache key part for one argument: shape, dtype and device for tensors, type otherwise."""
+    if isinstance(arg, torch.Tensor):
+        return ('T', tuple(arg.shape), arg.dtype, arg.device)
+    return ('S', type(arg))
+
 class Transform:
     """Base class for all function transformations."""
     
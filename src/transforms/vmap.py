@@ -3,11 +3,55 @@ Module: vmap.py
 Vectorized mapping transformation, similar to JAX's vmap.
 """
 
-from typing import Callable, Any, Tuple, List, Optional
+from typing import Callable, Any, Dict, Tuple, List, Optional
 import torch
 from .transform_base import Transform
-from ..core.tracer import Node, constant, trace
+from ..core.tracer import Node, constant, topological_sort, trace
 from ..metal.metal_ops import get_device, to_tensor
+from ..optimizations.fusion import POINTWISE_OPS
+
+# id(tuple) -> (tuple, tensor) for tuple arguments already converted. The
+# entry keeps its tuple alive, so the id is not reused while cached.
+_TENSOR_CACHE: Dict[int, Tuple[tuple, torch.Tensor]] = {}
+_TENSOR_CACHE_SIZE = 128
+
+def _as_batch(arg: Any, device: torch.device) -> torch.Tensor:
+    """
+    Convert a list or tuple argument to a tensor on ``device``.
+    
+    Tuples of numbers are immutable, so their tensor is cached and reused
+    when the same tuple is passed again; lists may have changed since the
+    last call and are converted every time.
+    """
+    if type(arg) is tuple and all(type(v) in (int, float) for v in arg):
+        entry = _TENSOR_CACHE.get(id(arg))
+        if entry is not None and entry[0] is arg:
+            return entry[1]
+        tensor = to_tensor(torch.as_tensor(arg), device)
+        if len(_TENSOR_CACHE) >= _TENSOR_CACHE_SIZE:
+            # Evict the oldest entry.
+            del _TENSOR_CACHE[next(iter(_TENSOR_CACHE))]
+        _TENSOR_CACHE[id(arg)] = (arg, tensor)
+        return tensor
+    return to_tensor(torch.as_tensor(arg), device)
+
+def _is_scalar_leaf(node: Node) -> bool:
+    """True if the constant ``node`` is a Python number or a 0-d tensor."""
+    value = node.value
+    if isinstance(value, torch.Tensor):
+        return value.dim() == 0
+    return type(value) in (int, float, bool)
+
+def _unaliased(result: torch.Tensor, inputs: List[torch.Tensor]) -> torch.Tensor:
+    """
+    Return ``result``, or a copy of it if it shares memory with one of
+    ``inputs`` (e.g. for an identity function), so that callers mutating the
+    result do not mutate their arguments.
+    """
+    ptr = result.untyped_storage().data_ptr()
+    if any(ptr == arg.untyped_storage().data_ptr() for arg in inputs):
+        return result.clone()
+    return result
 
 def vmap(fn: Callable = None):
     """
@@ -22,24 +66,98 @@ def vmap(fn: Callable = None):
     class VmapTransform(Transform):
         def __init__(self, fn: Callable):
             super().__init__(fn)
+            # Graph replay functions traced once per number of arguments
+            self.lowered = {}
+
+        def lower(self, fn: Callable, num_args: int, kwargs: dict) -> Optional[Tuple[Callable, bool]]:
+            """
+            Trace ``fn`` once on placeholder nodes and return a function that
+            replays the graph on new input values, plus whether the graph is
+            purely elementwise; None if ``fn`` cannot be traced into a graph.
             
+            The placeholders are scalars, so the traced graph does not depend
+            on the input shapes and one trace serves every batch size.
+            """
+            inputs = [constant(0.0) for _ in range(num_args)]
+            try:
+                output = fn(*inputs, **kwargs)
+            except Exception:
+                # e.g. fn inspects its (placeholder) input values while tracing
+                return None
+            if not isinstance(output, Node):
+                return None
+            # Whole-batch evaluation broadcasts every leaf against the batch,
+            # so it is only right for pointwise ops on scalar constants: a
+            # closed-over tensor would be combined with the batch itself.
+            placeholders = {id(node) for node in inputs}
+            elementwise = all(
+                id(n) in placeholders
+                or (_is_scalar_leaf(n) if n.op == "const" else n.op in POINTWISE_OPS)
+                for n in topological_sort(output)
+            )
+
+            def replay(*values):
+                for node, value in zip(inputs, values):
+                    node.value = value
+                try:
+                    return trace(output)
+                finally:
+                    # Don't keep the batched tensors alive on the graph.
+                    for node in inputs:
+                        node.value = None
+
+            return replay, elementwise
+
         def transform(self, fn: Callable) -> Callable:
             def wrapped(*args, **kwargs):
-                # Convert inputs to tensors and create batch dimension
+                # Convert inputs to tensors on the compute device and create
+                # the batch dimension
+                device = get_device()
                 batched_args = []
                 for arg in args:
                     if isinstance(arg, (list, tuple)):
-                        arg = torch.tensor(arg)
-                    if isinstance(arg, torch.Tensor):
-                        # Move tensor to CPU for consistency
-                        batched_args.append(arg.cpu())
+                        batched_args.append(_as_batch(arg, device))
+                    elif isinstance(arg, torch.Tensor):
+                        batched_args.append(to_tensor(arg, device))
                     else:
                         # Broadcast scalar to match batch size
                         batch_size = max(arg.shape[0] for arg in batched_args) if batched_args else 1
-                        batched_args.append(torch.full((batch_size,), arg).cpu())
+                        batched_args.append(torch.full((batch_size,), arg, device=device))
                 
-                # Apply function to each element
-                results = []
+                # Trace the graph once per number of arguments
+                if kwargs:
+                    lowered = self.lower(fn, len(batched_args), kwargs)
+                else:
+                    if len(batched_args) not in self.lowered:
+                        self.lowered[len(batched_args)] = self.lower(fn, len(batched_args), kwargs)
+                    lowered = self.lowered[len(batched_args)]
+                if lowered is not None:
+                    replay, elementwise = lowered
+                    stacked = None
+                    batch_shape = batched_args[0].shape if batched_args else None
+                    if elementwise and all(arg.shape == batch_shape for arg in batched_args):
+                        # Every op broadcasts: evaluate the graph once on the
+                        # whole batch.
+                        result = replay(*batched_args)
+                        if isinstance(result, torch.Tensor) and result.shape[:1] == batch_shape[:1]:
+                            stacked = result
+                    if stacked is None:
+                        try:
+                            stacked = torch.vmap(replay)(*batched_args)
+                        except Exception:
+                            # Ops without batching rules fall back to the per-element loop
+                            stacked = None
+                    if stacked is not None:
+                        # Tuple arguments share one cached tensor between
+                        # calls, which must not reach the caller either.
+                        stacked = _unaliased(stacked, batched_args)
+                        if stacked.dim() > 0 and stacked.shape[-1] == 1:
+                            stacked = stacked.squeeze(-1)
+                        return stacked
+
+                # Apply function to each element, writing the results into
+                # one output allocated from the first result's shape and dtype
+                stacked = None
                 for i in range(len(batched_args[0])):
                     # Extract i-th element from each argument
                     single_args = [arg[i].reshape(()) for arg in batched_args]  # Convert to scalar tensors
@@ -48,10 +166,20 @@ def vmap(fn: Callable = None):
                     # Only trace if result is a Node
                     if isinstance(result, Node):
                         result = trace(result)
-                    results.append(result)
-                
-                # Stack results along batch dimension and ensure CPU
-                stacked = torch.stack(results).cpu()
+                    result = torch.as_tensor(result, device=batched_args[0].device)
+                    if stacked is None:
+                        stacked = torch.empty(
+                            (len(batched_args[0]),) + result.shape,
+                            dtype=result.dtype,
+                            device=result.device,
+                        )
+                    elif result.dtype != stacked.dtype:
+                        # Promote like torch.stack instead of truncating,
+                        # e.g. int results followed by a float one.
+                        dtype = torch.promote_types(stacked.dtype, result.dtype)
+                        if dtype != stacked.dtype:
+                            stacked = stacked.to(dtype)
+                    stacked[i] = result
                 
                 # Squeeze any extra dimensions
                 if stacked.shape[-1] == 1:
@@ -4,28 +4,28 @@ Provides utilities to visualize the computation graph using Graphviz.
 """
 
 from graphviz import Digraph
-from ..core.tracer import Node
+from ..core.tracer import Node, topological_sort
 
-def visualize(graph: Node, filename: str = "graph"):
+def _label(node: Node) -> str:
+    """Return the node's label, escaped for use inside a quoted DOT string."""
+    label = str(node.op) if node.value is None else f"{node.op}({node.value})"
+    return label.replace('\\', '\\\\').replace('"', '\\"')
+
+def visualize(graph: Node, filename: str = "graph", view: bool = False):
     """
     Visualize the computation graph and save it to a file.
-    
+
     Args:
         graph (Node): The root node of the computation graph.
         filename (str): The base filename for the output (without extension).
+        view (bool): Open the rendered file in the default viewer.
     """
     dot = Digraph(comment='Computation Graph')
-    visited = set()
-
-    def add_node(node: Node):
-        if node.id in visited:
-            return
-        visited.add(node.id)
-        label = node.op if node.value is None else f"{node.op}({node.value})"
-        dot.node(node.id, label)
-        for inp in node.inputs:
-            dot.edge(inp.id, node.id)
-            add_node(inp)
+    # Driven by one topological pass, shared with the optimization passes
+    # when the root caches its order. The statements are written to the
+    # body directly instead of one dot.node/dot.edge call each.
+    order = topological_sort(graph)
+    dot.body.extend(f'\tn{node.id} [label="{_label(node)}"]\n' for node in order)
+    dot.body.extend(f'\tn{inp.id} -> n{node.id}\n' for node in order for inp in node.inputs)
 
-    add_node(graph)
-    dot.render(filename, view=True)
\ No newline at end of file
+    dot.render(filename, view=view)
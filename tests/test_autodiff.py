@@ -4,8 +4,10 @@ Unit tests for the automatic differentiation functionality.
 """
 
 import unittest
-from src.core.tracer import constant, add, mul
-from src.core.autodiff import compute_gradients
+import torch
+from src.core.tracer import Node, constant, add, mul, div, trace, GraphArena
+from src.core.autodiff import compute_gradients, topological_sort
+from src.metal.metal_ops import get_device, metal_add, metal_div, to_tensor
 
 class TestAutoDiff(unittest.TestCase):
     def test_addition_grad(self):
@@ -26,5 +28,125 @@ class TestAutoDiff(unittest.TestCase):
         self.assertNotEqual(a.grad, 0)
         self.assertNotEqual(b.grad, 0)
 
+    def test_tensor_gradients(self):
+        x = constant(torch.tensor([1.0, 2.0]))
+        y = constant(3)
+        compute_gradients(div(mul(x, y), add(x, constant(1.0))))
+        # d/dx [3x / (x + 1)] = 3 / (x + 1)^2
+        torch.testing.assert_close(x.grad, torch.tensor([0.75, 1.0 / 3.0]))
+        torch.testing.assert_close(y.grad, torch.tensor([0.5, 2.0 / 3.0]))
+
+    def test_tensor_gradient_buffers(self):
+        x = constant(torch.tensor([1.0, 2.0]))
+        expr = add(mul(x, x), x)
+        compute_gradients(expr)
+        buffer = x.grad
+        # A second pass zeroes and reuses the buffers instead of accumulating.
+        compute_gradients(expr)
+        self.assertIs(x.grad, buffer)
+        torch.testing.assert_close(x.grad, torch.tensor([3.0, 5.0]))
+        # New shapes get new buffers.
+        x.value = torch.tensor([1.0, 2.0, 3.0])
+        compute_gradients(expr)
+        torch.testing.assert_close(x.grad, torch.tensor([3.0, 5.0, 7.0]))
+
+    def test_custom_grad_fn(self):
+        # A custom node with a derivative but no evaluator.
+        def triple(x):
+            node = Node("triple", [x])
+            node.metadata['grad_fn'] = lambda n: [3 * n.grad]
+            return node
+
+        x = constant(2.0)
+        compute_gradients(triple(x))
+        self.assertEqual(x.grad, 3.0)
+        compute_gradients(add(triple(x), x))
+        self.assertEqual(x.grad, 4.0)
+        # Derivatives that need the custom node's value still fail.
+        with self.assertRaises(ValueError):
+            compute_gradients(mul(triple(x), x))
+
+    def test_deep_graph_topological_sort(self):
+        # Deeper than the default recursion limit.
+        x = constant(1.0)
+        expr = x
+        for _ in range(5000):
+            expr = add(expr, x)
+        order = topological_sort(expr)
+        self.assertEqual(len(order), 5001)
+        self.assertIs(order[-1], expr)
+        compute_gradients(expr)
+        self.assertEqual(x.grad, 5001)
+
+    def test_deep_graph_evaluate(self):
+        x = constant(1.0)
+        expr = x
+        for _ in range(5000):
+            expr = mul(expr, x)
+        self.assertEqual(trace(expr), 1.0)
+        compute_gradients(expr)
+        self.assertEqual(x.grad, 5001)
+
+    def test_wide_graph_gradients(self):
+        # Wide and shallow enough to take the vectorized reverse pass.
+        xs = [constant(float(i)) for i in range(1, 129)]
+        terms = [add(mul(x, x), div(x, constant(4.0))) for x in xs]
+        while len(terms) > 1:
+            terms = [add(terms[i], terms[i + 1]) for i in range(0, len(terms), 2)]
+        compute_gradients(terms[0])
+        for x in xs:
+            self.assertAlmostEqual(x.grad, 2 * x.value + 0.25)
+
+        # Repeated calls reuse the cached plan and see updated leaf values.
+        xs[0].value = 10.0
+        compute_gradients(terms[0])
+        self.assertAlmostEqual(xs[0].grad, 20.25)
+
+    def test_graph_arena(self):
+        x = constant(2.0)
+        with GraphArena() as arena:
+            expr = add(mul(x, x), 1.0)
+        # mul, the implicit constant(1.0) and add belong to the arena.
+        self.assertEqual(len(arena), 3)
+        self.assertEqual(trace(expr), 5.0)
+        arena.release()
+        self.assertEqual(len(arena), 0)
+
+    def test_topological_sort_cache_invalidation(self):
+        a = constant(2)
+        b = constant(3)
+        expr = add(a, b)
+        # Only explicit roots memoize their order, without the root itself.
+        topological_sort(expr)
+        self.assertIsNone(expr._topo_cache)
+        self.assertEqual(topological_sort(expr, memoize=True), [a, b, expr])
+        self.assertNotIn(expr, expr._topo_cache[1])
+        self.assertEqual(topological_sort(expr), [a, b, expr])
+        c = constant(4)
+        expr.inputs = [a, c]
+        order = topological_sort(expr, memoize=True)
+        self.assertIn(c, order)
+        self.assertNotIn(b, order)
+        # Rewiring to the same nodes keeps the cached order.
+        cached = expr._topo_cache
+        expr.inputs = [a, c]
+        self.assertIs(expr._topo_cache, cached)
+        self.assertEqual(topological_sort(expr), order)
+
+    def test_tensor_inputs_stay_on_device(self):
+        device = get_device()
+        x = to_tensor(torch.tensor([1.0, 2.0]), device)
+        # Tensors already on the device are returned without a copy.
+        self.assertIs(to_tensor(x, device), x)
+        result = trace(add(mul(constant(x), constant(x)), constant(1.0)))
+        self.assertEqual(result.device.type, device.type)
+        self.assertEqual(result.tolist(), [2.0, 5.0])
+
+    def test_metal_ops_scalar_fast_path(self):
+        self.assertIs(get_device(), get_device())
+        self.assertEqual(metal_add(2, 3), 5)
+        self.assertIsInstance(metal_div(1, 4), float)
+        self.assertIsInstance(metal_add(torch.tensor(2.0), 3), torch.Tensor)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -4,8 +4,11 @@ Unit tests for the compiler and optimization passes.
 """
 
 import unittest
-from src.core.tracer import constant, add
-from src.core.compiler import Compiler
+import torch
+from src.core.tracer import Node, Op, constant, add, mul, div, neg, square, trace
+from src.core.autodiff import compute_gradients
+from src.core.compiler import Compiler, apply_patterns
+from src.optimizations import cse, fusion, jax_backend, patterns
 
 class TestCompiler(unittest.TestCase):
     def test_constant_folding(self):
@@ -17,5 +20,219 @@ class TestCompiler(unittest.TestCase):
         self.assertEqual(optimized_expr.op, "const")
         self.assertEqual(optimized_expr.value, 5)
 
+    def test_simplify(self):
+        x = Node("placeholder")
+        expr = div(add(mul(x, constant(1)), constant(0)), constant(1))
+        self.assertIs(patterns.simplify(expr), x)
+        # Only constants match: a zero value left over from a trace does not.
+        x.value = 0
+        expr = mul(x, constant(3))
+        self.assertIs(patterns.simplify(expr), expr)
+        # Constant subgraphs fold, including unary ops.
+        self.assertEqual(patterns.simplify(neg(add(constant(2), constant(3)))).value, -5)
+
+    def test_op_codes(self):
+        x = constant(2.0)
+        self.assertEqual((x.op_code, square(x).op_code), (Op.CONST, Op.SQUARE))
+        self.assertEqual(Node("fma").op_code, Op.FMA)
+        # Custom ops have no code and match no pattern or fusion.
+        custom = Node("triple", [x])
+        self.assertIsNone(custom.op_code)
+        self.assertIs(patterns.simplify(mul(custom, constant(1))), custom)
+        self.assertFalse(fusion.can_fuse(custom, add(custom, x)))
+
+    def test_integer_folding(self):
+        expr = mul(add(constant(2), constant(3)), constant(4))
+        folded = Compiler().compile(expr)
+        self.assertIs(type(folded.value), int)
+        self.assertEqual(folded.value, 20)
+        self.assertEqual(folded.dtype, torch.int64)
+        # Division promotes to float.
+        folded = Compiler().compile(div(expr, constant(8)))
+        self.assertEqual(folded.value, 2.5)
+        self.assertEqual(folded.dtype, torch.get_default_dtype())
+
+    def test_apply_patterns(self):
+        total = add(constant(2.0), constant(3.0))
+        self.assertIs(apply_patterns(mul(total, constant(1))), total)
+        self.assertEqual(apply_patterns(mul(total, constant(0))).value, 0)
+        # Patterns are only tried on nodes of the op they target.
+        self.assertIs(apply_patterns(total), total)
+
+    def test_power_patterns(self):
+        # g(x) = x^2 - 1/x^3
+        x = constant(2.0)
+        expr = add(mul(x, x), mul(constant(-1.0), div(constant(1.0), mul(x, mul(x, x)))))
+        simplified = apply_patterns(expr)
+        square, negated = simplified.inputs
+        self.assertEqual((square.op, negated.op), ("square", "neg"))
+        self.assertEqual(negated.inputs[0].op, "recip")
+        self.assertEqual(negated.inputs[0].inputs[0].op, "cube")
+        self.assertAlmostEqual(trace(simplified), 3.875)
+
+        compute_gradients(simplified)
+        self.assertAlmostEqual(x.grad, 2 * 2.0 + 3 / 2.0 ** 4)
+
+    def test_hash_consing(self):
+        a = constant(2)
+        b = constant(3)
+        self.assertIs(add(a, b), add(a, b))
+        self.assertIs(mul(a, b), mul(b, a))
+        self.assertIsNot(div(a, b), div(b, a))
+
+        # Rewiring a node drops it from the table.
+        expr = add(a, b)
+        expr.inputs = [a, constant(4)]
+        self.assertIsNot(add(a, b), expr)
+
+    def test_merge_identical(self):
+        a = constant(2.0)
+        b = constant(3.0)
+        # Built directly, bypassing the hash-consing factories.
+        left = Node("div", [a, b])
+        expr = add(add(left, Node("div", [a, b])), Node("div", [b, a]))
+        merged = cse.merge_identical(expr)
+        self.assertIs(merged.inputs[0].inputs[1], left)
+        self.assertIsNot(merged.inputs[1], left)
+        self.assertAlmostEqual(trace(merged), 2 * 2.0 / 3.0 + 1.5)
+
+    def test_two_term_cse(self):
+        x = constant(2.0)
+        y = constant(3.0)
+        z = constant(5.0)
+        # Same operands, associated differently: identity CSE cannot merge them.
+        expr = mul(add(add(x, y), z), add(add(x, z), y))
+        optimized = cse.optimize(expr)
+        self.assertIs(optimized.inputs[0], optimized.inputs[1])
+        self.assertEqual(trace(optimized), 100.0)
+
+    def test_fusion_deep_graph(self):
+        c = constant(1.0)
+        x = constant(2.0)
+        for _ in range(2000):
+            x = add(mul(x, c), c)
+        # Deeper than the recursion limit; every mul -> add pair is one group.
+        self.assertEqual(len(fusion.find_fusion_candidates(x)), 2000)
+        # The pass simplifies first, which folds the all-constant chain.
+        self.assertEqual(trace(fusion.optimize(x)), 2002.0)
+
+    def test_optimize_pipeline(self):
+        a, b, c = (Node("input") for _ in range(3))
+        a.value, b.value, c.value = 2.0, 3.0, 5.0
+        # Simplifying x * 1 exposes a multiply-add in the same sweep.
+        expr = add(mul(mul(a, b), constant(1)), c)
+        optimized = fusion.optimize_pipeline(expr)
+        self.assertEqual(optimized.op, "fma")
+        self.assertEqual(optimized.inputs, [a, b, c])
+        self.assertEqual(trace(optimized), 11.0)
+        # A product with a second use is not fused into its first user.
+        shared = mul(a, mul(b, constant(1)))
+        expr = mul(add(shared, c), shared)
+        optimized = fusion.optimize_pipeline(expr)
+        self.assertEqual([n.op for n in optimized.inputs], ["add", "mul"])
+        self.assertEqual(trace(optimized), 66.0)
+        # The user of a fused node is rebuilt, without allocating metadata.
+        expr = mul(add(mul(a, b), c), a)
+        optimized = fusion.optimize_pipeline(expr)
+        self.assertIsNot(optimized, expr)
+        self.assertEqual(optimized.inputs[0].op, "fma")
+        self.assertIsNone(optimized._metadata)
+
+    def test_fusion_patterns(self):
+        a, b, c, d = (constant(v) for v in (2.0, 3.0, 5.0, 7.0))
+        expr = mul(add(add(mul(a, b), c), d), add(neg(mul(c, d)), a))
+        groups = fusion.find_fusion_candidates(expr)
+        fused = [fusion.create_fused_op(group) for group in groups]
+        self.assertEqual(sorted(node.op for node in fused), ["fma_add", "fnma"])
+        for group, node in zip(groups, fused):
+            self.assertAlmostEqual(trace(node), trace(group[-1]))
+        # An input shared by two ops of the chain is passed to both.
+        product = mul(a, b)
+        fused = fusion.create_fused_op([product, add(product, a)])
+        self.assertEqual(fused.inputs, [a, b, a])
+        self.assertEqual(trace(fused), 8.0)
+        # Fused ops are evaluated by name, without their metadata.
+        x, y, z = (constant(torch.tensor([1.0, -2.0])) for _ in range(3))
+        for op, expected in (("fma", x.value * y.value + z.value), ("fnma", z.value - x.value * y.value)):
+            torch.testing.assert_close(trace(Node(op, [x, y, z])), expected)
+
+        # A producer with a second consumer is not fused away.
+        shared = mul(a, b)
+        expr = mul(add(shared, c), shared)
+        self.assertTrue(fusion.can_fuse(shared, expr.inputs[0]))
+        self.assertFalse(fusion.can_fuse(shared, expr.inputs[0], fusion.count_uses(expr)))
+        self.assertEqual(fusion.find_fusion_candidates(expr), [])
+
+        # Known, different shapes are not fused; unknown shapes are.
+        product = mul(a, b)
+        expr = add(product, c)
+        product.shape, expr.shape = (3,), (2, 3)
+        self.assertFalse(fusion.can_fuse(product, expr))
+        expr.shape = None
+        self.assertTrue(fusion.can_fuse(product, expr))
+        product.dtype, expr.dtype = torch.float16, torch.float32
+        self.assertFalse(fusion.can_fuse(product, expr))
+        expr.dtype = torch.float16
+        self.assertTrue(fusion.can_fuse(product, expr))
+        self.assertEqual(fusion.create_fused_op([product, expr]).dtype, torch.float16)
+        self.assertIsNone(product._metadata)
+
+    def test_compiled_region_errors(self):
+        region = fusion.CompiledRegion(lambda a: a + 1)
+        x = torch.tensor([1.0])
+
+        def compile_failure(*args):
+            raise fusion.TorchDynamoException("backend failed")
+
+        # A compiler failure falls back to eager execution for good.
+        region.compiled = compile_failure
+        with self.assertLogs(level="WARNING"):
+            torch.testing.assert_close(region(x), x + 1)
+        self.assertIs(region.compiled, region.fn)
+
+        # Other errors are not swallowed.
+        def runtime_error(*args):
+            raise ValueError("bad region")
+
+        region.compiled = runtime_error
+        with self.assertRaises(ValueError):
+            region(x)
+        self.assertIs(region.compiled, runtime_error)
+
+    def test_fuse_pointwise(self):
+        x = constant(2.0)
+        y = constant(3.0)
+        shared = square(x)
+        expr = div(add(shared, y), neg(add(shared, x)))
+        expected = trace(expr)
+        fused = fusion.fuse_pointwise(expr)
+        # The shared square stays a separate output; the rest is one region.
+        self.assertEqual(fused.op, "fused")
+        self.assertIs(fused.inputs[0], shared)
+        self.assertAlmostEqual(trace(fused), expected)
+
+        x.value = 1.0
+        self.assertAlmostEqual(trace(fused), -2.0)
+
+    def test_numba_backend(self):
+        x = constant(2.0)
+        expr = div(add(mul(x, x), constant(1.0)), x)
+        compiler = Compiler(backend="numba")
+        kernel = compiler.compile(expr)
+        self.assertAlmostEqual(kernel(), trace(expr))
+        self.assertIs(compiler.compile(expr), kernel)
+
+        # The kernel reads leaf values at call time.
+        x.value = 4.0
+        self.assertAlmostEqual(kernel(), 17.0 / 4.0)
+
+    @unittest.skipIf(jax_backend.jax is None, "jax is not installed")
+    def test_jax_backend(self):
+        x = constant(torch.tensor([1.0, 2.0, 4.0]))
+        expr = div(add(mul(x, x), constant(1.0)), x)
+        program = Compiler(backend="jax").compile(expr)
+        torch.testing.assert_close(torch.tensor(program().tolist()), trace(expr))
+        self.assertAlmostEqual(float(program(3.0, 1.0)), 10.0 / 3.0, places=5)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -3,12 +3,14 @@ Tests for JAX-style transformations (jit, vmap, grad).
 """
 
 import unittest
+from unittest import mock
 import torch
 import numpy as np
 from src.transforms.jit import jit
-from src.transforms.vmap import vmap
-from src.transforms.grad import grad, value_and_grad
-from src.core.tracer import constant, add, mul, div, trace
+from src.transforms.vmap import vmap, _as_batch
+from src.transforms.grad import grad, value_and_grad, _tape_key, _value_and_grads
+from src.core.tracer import Node, constant, add, mul, div, register_op, trace
+from src.metal.metal_ops import get_device
 
 class TestTransformations(unittest.TestCase):
     def test_jit(self):
@@ -26,6 +28,46 @@ class TestTransformations(unittest.TestCase):
         result1 = f(3.0)
         result2 = f(3.0)
         self.assertAlmostEqual(result1, result2)
+        # The cached graph is re-evaluated on the new input
+        self.assertAlmostEqual(result1, 10.0)
+
+    def test_jit_function_calls(self):
+        @jit
+        def f(x):
+            # An op codegen has no template for.
+            tripled = Node("triple", [x])
+            tripled.metadata['fn'] = lambda a: 3 * a
+            return add(tripled, constant(1.0))
+
+        self.assertAlmostEqual(f(2.0), 7.0)
+        self.assertAlmostEqual(f(4.0), 13.0)
+        # Registered ops are called from the generated code, under a name
+        # from the node's position.
+        g = jit(lambda x, y, z: Node("fma", [x, y, z]))
+        self.assertAlmostEqual(g(2.0, 3.0, 1.0), 7.0)
+        (cached,) = g.cache.values()
+        self.assertIn("_op0(x0, x1, x2)", cached.compiled_fn.__source__)
+        # Op names need not be identifiers.
+        register_op("fn-1.b", lambda a: a + 1.0)
+        h = jit(lambda x: Node("fn-1.b", [Node("fn-1.b", [x])]))
+        self.assertAlmostEqual(h(2.0), 4.0)
+
+    def test_jit_cache_key(self):
+        @jit
+        def f(x, scale=1.0):
+            return mul(x, constant(scale))
+
+        f(torch.tensor([1.0]))
+        f(torch.tensor([[1.0, 2.0], [3.0, 4.0]]))
+        self.assertEqual(len(f.cache), 2)
+        # Keyword arguments are baked into the trace.
+        torch.testing.assert_close(f(torch.tensor([1.0]), scale=3.0), torch.tensor([3.0]))
+        torch.testing.assert_close(f(torch.tensor([1.0])), torch.tensor([1.0]))
+        self.assertEqual(len(f.cache), 3)
+        # Tensor keyword arguments are traced each call, not cached.
+        for _ in range(2):
+            torch.testing.assert_close(f(torch.tensor([1.0]), scale=torch.tensor(2.0)), torch.tensor([2.0]))
+        self.assertEqual(len(f.cache), 3)
         
     def test_vmap(self):
         """Test vectorized mapping transformation."""
@@ -39,6 +81,77 @@ class TestTransformations(unittest.TestCase):
         result = f(x)
         expected = torch.tensor([2.0, 5.0, 10.0])  # x^2 + 1 for each input
         torch.testing.assert_close(result, expected)
+
+        # Tuple inputs are converted once; lists may change between calls.
+        xs = (1.0, 2.0, 3.0)
+        torch.testing.assert_close(f(xs), expected)
+        device = get_device()
+        self.assertIs(_as_batch(xs, device), _as_batch(xs, device))
+        xs = [1.0, 2.0, 3.0]
+        first = _as_batch(xs, device)
+        xs[0] = 4.0
+        torch.testing.assert_close(_as_batch(xs, device), torch.tensor([4.0, 2.0, 3.0]))
+        torch.testing.assert_close(first, torch.tensor([1.0, 2.0, 3.0]))
+
+    def test_vmap_benchmark_shapes(self):
+        """vmap output shapes match examples/jax_style.py."""
+
+        @vmap
+        def f(x):
+            return add(mul(x, x), constant(1.0))
+
+        x_batch = torch.linspace(0, 10, 1000)
+        # Elementwise graphs are evaluated once on the whole batch.
+        with mock.patch("torch.vmap") as torch_vmap:
+            result = f(x_batch)
+        torch_vmap.assert_not_called()
+        self.assertEqual(result.shape, x_batch.shape)
+        torch.testing.assert_close(result, x_batch * x_batch + 1.0)
+
+        @vmap
+        def g(x, y):
+            return div(x, y)
+
+        torch.testing.assert_close(g(x_batch, 2.0), x_batch / 2.0)
+
+        # The result is never the input itself.
+        x = torch.tensor([1.0, 2.0, 3.0])
+        vmap(lambda a: a)(x).mul_(100)
+        torch.testing.assert_close(x, torch.tensor([1.0, 2.0, 3.0]))
+        # Nor the cached tensor of a tuple argument, on either batched path.
+        xs = (1.0, 2.0, 3.0)
+        vmap(lambda a: a)(xs).mul_(100)
+        vmap(lambda a, b: a)(xs, torch.ones(3, 2)).mul_(100)
+        torch.testing.assert_close(vmap(lambda a: a)(xs), x)
+
+    def test_vmap_closure_tensor(self):
+        """Closed-over tensors are not broadcast against the batch."""
+        w = torch.tensor([1.0, 10.0, 100.0])
+        f = vmap(lambda x: mul(x, w))
+        for n in (3, 4):
+            x = torch.arange(1.0, n + 1)
+            torch.testing.assert_close(f(x), x[:, None] * w)
+
+    def test_vmap_loop_fallback(self):
+        """Functions that cannot be traced are mapped element by element."""
+
+        @vmap
+        def relu(x):
+            # Inspecting the value fails on the tracing placeholder.
+            return x if float(x) > 0 else x * 0
+
+        x = torch.tensor([-1.0, 2.0, -3.0, 4.0])
+        result = relu(x)
+        torch.testing.assert_close(result, torch.clamp(x, min=0))
+        self.assertEqual(result.dtype, x.dtype)
+
+        # Later results of a wider dtype promote the output.
+        @vmap
+        def halve_odd(x):
+            return x if int(x) % 2 == 0 else x / 2
+
+        result = halve_odd(torch.tensor([2, 3, 4]))
+        torch.testing.assert_close(result, torch.tensor([2.0, 1.5, 4.0]))
         
     def test_grad(self):
         """Test gradient transformation."""
@@ -62,6 +175,71 @@ class TestTransformations(unittest.TestCase):
         self.assertAlmostEqual(grad_x, 4.0)
         self.assertAlmostEqual(grad_y, 1.0)
         
+    def test_grad_tape_cache(self):
+        traces = []
+
+        def f(x, y):
+            traces.append(1)
+            return div(mul(x, x), y)
+
+        df = grad(f, argnums=(0, 1))
+        self.assertEqual(df(2.0, 4.0), (1.0, -0.25))
+        # Same argument kinds: the recorded tape is replayed without tracing.
+        self.assertEqual(df(3.0, 9.0), (2.0 / 3.0, -1.0 / 9.0))
+        self.assertEqual(len(traces), 1)
+
+        x = torch.tensor([1.0, 2.0])
+        gx, _ = df(x, 2.0)
+        torch.testing.assert_close(gx, x)
+        self.assertEqual(len(traces), 2)
+
+        # Nodes built before the trace are re-read on every replay.
+        w = constant(1.0)
+        dw = grad(lambda x: mul(x, w))
+        self.assertEqual(dw(2.0), 1.0)
+        w.value = 5.0
+        self.assertEqual(dw(2.0), 5.0)
+
+        # A trace that branches on an argument's value is not replayed.
+        h = grad(lambda x: mul(x, x) if x.value > 0 else mul(x, constant(3.0)))
+        self.assertEqual(h(1.0), 2.0)
+        self.assertEqual(h(-1.0), 3.0)
+
+        # Static scalars are keyed by value, in a bounded cache.
+        tapes = {}
+        with mock.patch('src.transforms.grad._MAX_TAPES', 4):
+            for step in range(10):
+                _value_and_grads(lambda x, s: mul(x, constant(s)), (1.0, float(step)),
+                                 {}, (0,), False, tapes)
+        self.assertEqual(len(tapes), 4)
+        self.assertIsNone(_tape_key((2.0, float('nan')), {}, (0,)))
+
+        # Tensor keyword arguments are baked into the trace and not cached.
+        dg = grad(lambda x, scale=1.0: mul(x, constant(scale)))
+        torch.testing.assert_close(dg(2.0, scale=torch.tensor(3.0)), torch.tensor(3.0))
+        self.assertIsNone(_tape_key((2.0,), {'scale': torch.tensor(3.0)}, (0,)))
+        self.assertIsNotNone(_tape_key((2.0,), {'scale': 3.0}, (0,)))
+
+    def test_grad_custom_node(self):
+        """Custom nodes are not recorded, so they are never replayed stale."""
+
+        def triple(x):
+            node = Node("triple", [x])
+            node.metadata['fn'] = lambda a: 3 * a
+            node.metadata['grad_fn'] = lambda n: [3 * n.grad]
+            return node
+
+        f = value_and_grad(lambda x: mul(triple(x), x))
+        self.assertEqual(f(2.0), (12.0, 12.0))
+        self.assertEqual(f(5.0), (75.0, 30.0))
+        # grad needs no value, so a node with only a grad_fn is enough.
+        def scaled(x):
+            node = Node("scaled", [x])
+            node.metadata['grad_fn'] = lambda n: [2 * n.grad]
+            return node
+
+        self.assertEqual(grad(lambda x: add(scaled(x), x))(3.0), 3.0)
+
     def test_value_and_grad(self):
         """Test value_and_grad transformation."""
         